@@ -0,0 +1,259 @@
+"""
+Extract many Teams caches at once (eg. one per user profile), split into shards that can be run
+independently - by separate processes, or separate machines sharing the output folder - then
+merge what every shard found into one report.
+
+Every cache file and index entry of every cache root is put in one of --shards shards by a hash
+of its path (see file_to_extension.in_shard), so a shard always has the same work, whichever
+machine runs it and however many times. Roots have to be listed the same way on every machine.
+A shard extracts its part of each root to a Saved folder of its own under output\\shard_NNN, with
+its own manifest, and checkpoints every root it finishes (output\\shard_NNN\\<root>.json, with its
+counts and unknown signatures). Once every root is done it writes output\\shard_NNN.json.
+
+A shard that fails part way can just be run again - roots it has already finished are skipped,
+and whatever the one it was on had saved is deleted, so it is extracted again from the start and
+counted the same as if it had never failed. Once every shard has finished, --merge combines them
+into output\\manifest.sqlite (every source of every root, and the outputs it produced) and
+output\\report.json (counts, types and unknown signatures).
+
+Usage: python batch.py <roots file> <output folder> --shards N [--shard I] [--jobs N] [--merge]
+
+Author - James M. (yakasov)
+"""
+
+from collections import Counter
+from multiprocessing.connection import wait
+from os.path import isdir, isfile, join
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import zlib
+
+import file_to_extension as fte
+from blockfile import key_to_name
+from dedupe import new_digest
+from discovery import SignatureCounter, dump_counts, load_counts
+from manifest import MANIFEST_NAME, Manifest
+from sinks import SINKS
+
+REPORT_NAME = 'report.json'
+
+def read_roots(path):
+    """Read the list of cache roots - one folder per line, blank lines and # comments are skipped.
+
+    :param path: full file path of the list
+    :returns:    list of cache folders, in order
+    :raises ValueError: if the list is empty or has a root twice
+    """
+    with open(path, encoding='utf-8') as f:
+        roots = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    if not roots:
+        raise ValueError(f'No cache roots in {path}')
+    repeated = [root for root, count in Counter(roots).items() if count > 1]
+    if repeated:
+        raise ValueError(f'{repeated[0]} is listed more than once in {path}')
+    return roots
+
+def roots_digest(roots):
+    """Hash a list of roots, so shards run against different lists are never merged."""
+    digest = new_digest()
+    digest.update('\n'.join(roots).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+def root_folder(root):
+    """Return the name of a root's Saved folder in each shard - readable, but unique to the root."""
+    return key_to_name(root, zlib.crc32(root.encode('utf-8', 'surrogateescape')))
+
+def shard_folder(output, shard):
+    """Return the full directory path a shard saves to."""
+    return join(output, f'shard_{shard:03d}')
+
+def shard_result_path(output, shard):
+    """Return the full file path of a shard's result, which is only there once it has finished."""
+    return join(output, f'shard_{shard:03d}.json')
+
+def write_json(path, data):
+    """Write JSON to a file all at once - it is either all there or not there at all."""
+    with open(f'{path}.partial', 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1)
+    os.replace(f'{path}.partial', path)
+
+def run_shard(roots, output, shard, shards, options=None):
+    """Extract one shard of every root. Roots the shard has already finished are skipped.
+
+    :param roots:   cache folders, from read_roots
+    :param output:  full directory path every shard saves to
+    :param shard:   shard to run, from 0 to shards - 1
+    :param shards:  number of shards the work is split into
+    :param options: file_to_extension.Options for each root (save_path and shard are set here)
+    :returns:       shard result, as written to shard_NNN.json
+    """
+    options = (options or fte.Options())._replace(shard=(shard, shards))
+    folder = shard_folder(output, shard)
+    os.makedirs(folder, exist_ok=True)
+    started = time.perf_counter()
+    results = {}
+    for root in roots:
+        checkpoint = join(folder, f'{root_folder(root)}.json')
+        if isfile(checkpoint):
+            with open(checkpoint, encoding='utf-8') as f:
+                results[root] = json.load(f)
+            continue
+        save_path = join(folder, root_folder(root))
+        if isdir(save_path):
+            # Tried before and never checkpointed - start again, so everything is counted again
+            shutil.rmtree(save_path)
+        root_started = time.perf_counter()
+        for _ in fte.extract(root, options._replace(save_path=save_path)):
+            pass
+        results[root] = {'folder': root_folder(root),
+                         'seconds': round(time.perf_counter() - root_started, 3),
+                         'counts': fte.METRICS.counts, 'types': fte.METRICS.types,
+                         'unknown': dump_counts(fte.UNKNOWN.take())}
+        write_json(checkpoint, results[root])
+    result = {'shard': shard, 'shards': shards, 'roots': roots_digest(roots),
+              'seconds': round(time.perf_counter() - started, 3), 'results': results}
+    write_json(shard_result_path(output, shard), result)
+    return result
+
+def run_shards(roots, output, shards, jobs=1, options=None):
+    """Run every shard that hasn't finished yet, jobs at a time. Every shard runs in a process of
+    its own, so nothing is left over in the extractor's module settings from the one before. These
+    are plain processes rather than a process pool, as a pool's processes can't start the workers
+    a shard extracts with (--workers).
+
+    :param roots:   cache folders, from read_roots
+    :param output:  full directory path every shard saves to
+    :param shards:  number of shards the work is split into
+    :param jobs:    shards to run at once
+    :param options: file_to_extension.Options for each root
+    :returns:       dictionary of failed shard: error message
+    """
+    waiting = [shard for shard in range(shards) if not isfile(shard_result_path(output, shard))]
+    context = multiprocessing.get_context('spawn')
+    running, failed = {}, {}
+    while waiting or running:
+        while waiting and len(running) < jobs:
+            shard = waiting.pop(0)
+            process = context.Process(target=run_shard,
+                                      args=(roots, output, shard, shards, options))
+            process.start()
+            running[process.sentinel] = shard, process
+        for sentinel in wait(list(running)):
+            shard, process = running.pop(sentinel)
+            process.join()
+            if process.exitcode == 0:
+                print(f'Shard {shard} finished')
+            else:
+                print(f'Shard {shard} failed (exit code {process.exitcode})')
+                failed[shard] = f'exit code {process.exitcode}'
+    return failed
+
+def merge(roots, output, shards):
+    """Combine every shard's results and manifests into output\\manifest.sqlite and report.json.
+
+    :param roots:  cache folders, from read_roots
+    :param output: full directory path every shard saved to
+    :param shards: number of shards the work was split into
+    :returns:      report, as written to report.json
+    :raises ValueError: if a shard hasn't finished, or was run with other roots or shards
+    """
+    missing = [str(shard) for shard in range(shards)
+               if not isfile(shard_result_path(output, shard))]
+    if missing:
+        raise ValueError(f'Shards {", ".join(missing)} have not finished, run them first')
+    digest = roots_digest(roots)
+    counts, types = Counter(), Counter()
+    unknown = SignatureCounter()
+    per_root = {root: {'sources': 0, 'outputs': 0, 'types': Counter()} for root in roots}
+    path = join(output, MANIFEST_NAME)
+    if isfile(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE sources (root TEXT, shard INTEGER, source TEXT, size INTEGER, mtime REAL, '
+        'digest TEXT, outputs TEXT, PRIMARY KEY (root, source))')
+    try:
+        for shard in range(shards):
+            with open(shard_result_path(output, shard), encoding='utf-8') as f:
+                result = json.load(f)
+            if (result['shards'], result['roots']) != (shards, digest):
+                raise ValueError(f'Shard {shard} was run with other roots or another number of '
+                                 'shards')
+            for root, root_result in result['results'].items():
+                counts.update(root_result['counts'])
+                types.update(root_result['types'])
+                unknown.merge(load_counts(root_result['unknown']))
+                saved = join(shard_folder(output, shard), root_result['folder'])
+                manifest = Manifest(join(saved, MANIFEST_NAME))
+                try:
+                    sources = manifest.sources()
+                finally:
+                    manifest.close()
+                connection.executemany(
+                    'INSERT INTO sources VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(root, shard, name, s.size, s.mtime, s.digest, json.dumps(s.outputs))
+                     for name, s in sources])
+                per_root[root]['sources'] += len(sources)
+                per_root[root]['outputs'] += sum(len(s.outputs) for _, s in sources)
+                per_root[root]['types'].update(root_result['types'])
+        connection.commit()
+    finally:
+        connection.close()
+    report = {'roots': len(roots), 'shards': shards,
+              'sources': sum(r['sources'] for r in per_root.values()),
+              'outputs': sum(r['outputs'] for r in per_root.values()),
+              'counts': counts, 'types': types, 'per_root': per_root, 'unknown': unknown.report()}
+    write_json(join(output, REPORT_NAME), report)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Extract many Teams caches in shards, then merge them.')
+    parser.add_argument('roots',
+                        help='text file listing the cache folders to extract, one per line')
+    parser.add_argument('save_path', help='folder every shard saves to')
+    parser.add_argument('--shards', type=int, required=True,
+                        help='number of shards to split the work into, the same on every machine')
+    parser.add_argument('--shard', type=int,
+                        help='only run this shard (0 to shards - 1), eg. a different one per '
+                             'machine')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='shards to run at once when running them all (default: 1)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes each shard extracts with (default: 1)')
+    parser.add_argument('--output', choices=SINKS, default='dir',
+                        help='what each shard saves to, as in file_to_extension.py '
+                             '(default: dir)')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge every shard into one manifest and report, once they have '
+                             'all finished')
+    args = parser.parse_args()
+    if args.shards < 1 or (args.shard is not None and not 0 <= args.shard < args.shards):
+        parser.error('--shard has to be from 0 to --shards - 1')
+    if args.workers > 1 and args.output in ('tar', 'zip'):
+        parser.error('--workers can only be used with --output dir or sqlite')
+
+    cache_roots = read_roots(args.roots)
+    shard_options = fte.Options(workers=args.workers, output=args.output, verbose=False)
+    if args.merge:
+        merged = merge(cache_roots, args.save_path, args.shards)
+        print(f'Merged {args.shards} shards of {merged["roots"]} caches -- '
+              f'{merged["sources"]} sources -- {merged["outputs"]} outputs')
+        saved_types = merged['types'].most_common()
+        print(f'Saved {" -- ".join(f"{ext} {count}" for ext, count in saved_types)}')
+    elif args.shard is not None:
+        run_shard(cache_roots, args.save_path, args.shard, args.shards, shard_options)
+        print(f'Shard {args.shard} finished')
+    else:
+        shard_errors = run_shards(cache_roots, args.save_path, args.shards, args.jobs,
+                                  shard_options)
+        if shard_errors:
+            sys.exit(f'{len(shard_errors)} shards failed, run again to retry them '
+                     f'(or one at a time with --shard)')
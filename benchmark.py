@@ -0,0 +1,213 @@
+"""
+Benchmark each stage of the extractor against a fake cache from make_cache.py.
+
+Every stage is timed by running the pipeline up to and including it in a fresh process, and
+taking away the time of the run before it - stages are generators, so they can't be timed on
+their own. GZ payloads are only expanded when something reads them, so every run reads all
+expanded data to the end. For each stage this reports:
+
+    - files/s: payloads coming out of the stage per second of the stage's own time
+    - MB/s:    size of the whole cache per second of the stage's own time
+    - peak RSS of the process running the pipeline up to that stage
+
+After the last stage, every output is checked against make_cache.py's ground truth: a file
+counts as recovered if something with the same content was saved with the right extension.
+Index entries are checked for their name too - each should be saved under its URL.
+
+Usage: python benchmark.py [--files N] [--seed N] [--output dir|tar|zip|sqlite] [--byte-count N]
+                           [--index | --simple]
+
+Author - James M. (yakasov)
+"""
+
+from collections import Counter
+from ctypes import wintypes
+from os.path import getsize, join
+import argparse
+import ctypes
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+
+import file_to_extension as fte
+from make_cache import make_cache
+from metrics import Metrics
+from sinks import SINKS
+
+try:
+    import resource
+except ImportError: # Windows, which has GetProcessMemoryInfo instead
+    resource = None
+
+class ProcessMemoryCounters(ctypes.Structure):
+    """PROCESS_MEMORY_COUNTERS from psapi.h, for peak RSS on Windows."""
+    _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+STAGES = [ # Stage name: function taking the previous stage's output
+    ('source', None), # cache_source, which takes the cache folder instead
+    ('split', fte.split_stage),
+    ('classify', fte.classify_stage),
+    ('decompress', fte.decompress_stage),
+    ('save', fte.save_stage),
+]
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes, or None if we can't tell."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024 # Linux reports KB
+    counters = ProcessMemoryCounters(cb=ctypes.sizeof(ProcessMemoryCounters))
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+def drain(items):
+    """Read everything out of a stage, including all expanded data.
+
+    :param items: generator of Payload, (Payload, extension or None) or Result
+    :returns:     number of payloads
+    """
+    count = 0
+    for item in items:
+        payload = item if isinstance(item, (fte.Payload, fte.Result)) else item[0]
+        if isinstance(payload, fte.Payload) and payload.chunks is not None:
+            for _ in payload.chunks:
+                pass
+        count += 1
+    return count
+
+def run_stages(folder, stage_count, output, byte_count):
+    """Run the pipeline up to and including the first stage_count STAGES. Run in its own process.
+
+    :param folder:      full directory path of the cache
+    :param stage_count: number of STAGES to run
+    :param output:      sink name from sinks.SINKS for the save stage
+    :param byte_count:  null run length to split data files at, or None to pick one per file
+    :returns:           tuple of (seconds, payloads out of the last stage, peak RSS,
+                        (extension, digest, file name) of every output if the save stage was run)
+    """
+    fte.SPLIT_BYTE_COUNT = byte_count
+    outputs = []
+    fte.METRICS = Metrics(verbose=False)
+    with tempfile.TemporaryDirectory() as save_path:
+        fte.open_output(output, save_path)
+        start = time.perf_counter()
+        items = fte.cache_source(folder) if stage_count else ()
+        for _, stage in STAGES[1:stage_count]:
+            items = stage(items)
+        count = drain(items)
+        elapsed = time.perf_counter() - start
+        for locations in fte.OUTPUTS.values():
+            for location in locations:
+                name = re.split(r'[\\/]', location)[-1]
+                outputs.append((name.rsplit('.', 1)[-1] if '.' in name else 'DATA',
+                                fte.SINK.digest(location), name))
+        fte.SINK.close()
+    return elapsed, count, peak_rss(), outputs
+
+def accuracy(truth, outputs):
+    """Compare outputs against the ground truth.
+
+    :param truth:   ground truth from make_cache
+    :param outputs: (extension, digest, file name) of every output
+    :returns:       dictionary of counts
+    """
+    expected = Counter((t['ext'], t['digest']) for t in truth)
+    saved = Counter((ext, digest) for ext, digest, _ in outputs)
+    saved_digests = Counter(digest for _, digest, _ in outputs)
+    names = {name for _, _, name in outputs}
+    recovered = sum((expected & saved).values())
+    wrong_type = sum(min(count, saved_digests[digest]) for (_, digest), count in
+                     (expected - saved).items())
+    unexpected = sum(count for (ext, _), count in (saved - expected).items() if ext != 'DATA')
+    return {'expected': sum(expected.values()), 'recovered': recovered, 'wrong_type': wrong_type,
+            'missed': sum(expected.values()) - recovered - wrong_type, 'unexpected': unexpected,
+            'misnamed': sum(1 for t in truth if 'name' in t and t['name'] not in names)}
+
+def benchmark(folder, truth, output='dir', byte_count=None, repeat=1):
+    """Time every stage over a cache.
+
+    :param folder:     full directory path of the cache
+    :param truth:      ground truth from make_cache
+    :param output:     sink name from sinks.SINKS for the save stage
+    :param byte_count: null run length to split data files at, or None to pick one per file
+    :param repeat:     times to run each stage, the fastest run is kept
+    :returns:          dictionary of results
+    """
+    cache_size = sum(getsize(join(folder, f)) for f in os.listdir(folder))
+    context = multiprocessing.get_context('spawn') # A fresh process per run, for a fair peak RSS
+    runs = []
+    for stage_count in range(len(STAGES) + 1):
+        tries = []
+        for _ in range(repeat):
+            with context.Pool(1) as pool:
+                tries.append(pool.apply(run_stages, (folder, stage_count, output, byte_count)))
+        runs.append(min(tries, key=lambda run: run[0]))
+
+    stages = []
+    for i, (name, _) in enumerate(STAGES, 1):
+        seconds = max(runs[i][0] - runs[i - 1][0], 1e-9)
+        stages.append({'stage': name, 'seconds': seconds, 'payloads': runs[i][1],
+                       'files_per_second': runs[i][1] / seconds,
+                       'mb_per_second': cache_size / 1e6 / seconds, 'peak_rss': runs[i][2]})
+    return {'cache_bytes': cache_size, 'baseline_rss': runs[0][2], 'stages': stages,
+            'total_seconds': runs[-1][0], 'accuracy': accuracy(truth, runs[-1][3])}
+
+def print_results(results):
+    """Print benchmark results as a table."""
+    print(f'Cache: {results["cache_bytes"] / 1e6:.1f} MB')
+    print(f'{"Stage":<12}{"Seconds":>10}{"Payloads":>10}{"Files/s":>12}{"MB/s":>10}'
+          f'{"Peak RSS":>12}')
+    for stage in results['stages']:
+        rss = 'n/a' if stage['peak_rss'] is None else f'{stage["peak_rss"] / 1e6:.1f} MB'
+        print(f'{stage["stage"]:<12}{stage["seconds"]:>10.3f}{stage["payloads"]:>10}'
+              f'{stage["files_per_second"]:>12.0f}{stage["mb_per_second"]:>10.1f}{rss:>12}')
+    print(f'Total: {results["total_seconds"]:.3f}s')
+    score = results['accuracy']
+    print(f'Recovered {score["recovered"]} of {score["expected"]} '
+          f'({100 * score["recovered"] / max(score["expected"], 1):.1f}%) -- '
+          f'Wrong type {score["wrong_type"]} -- Missed {score["missed"]} -- '
+          f'Unexpected {score["unexpected"]} -- Misnamed {score["misnamed"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the extractor.')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='files in the fake cache (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the fake cache (default: 0)')
+    parser.add_argument('--max-size', type=int, default=256 * 1024,
+                        help='biggest file in the fake cache in bytes (default: 262144)')
+    parser.add_argument('--output', choices=SINKS, default='dir',
+                        help='sink to save to (default: dir)')
+    parser.add_argument('--byte-count', type=int,
+                        help='null run length to split data files at (default: picked per file)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per stage, the fastest is kept (default: 1)')
+    formats = parser.add_mutually_exclusive_group()
+    formats.add_argument('--index', action='store_true',
+                         help='benchmark a cache with its blockfile index (see make_cache.py)')
+    formats.add_argument('--simple', action='store_true',
+                         help='benchmark a simple format cache instead (see make_cache.py)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_folder:
+        cache_truth = make_cache(cache_folder, args.files, args.seed, args.max_size, args.simple,
+                                 args.index)
+        benchmark_results = benchmark(cache_folder, cache_truth, args.output, args.byte_count,
+                                      args.repeat)
+    print_results(benchmark_results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(benchmark_results, f, indent=1)
@@ -0,0 +1,181 @@
+"""
+Read a Chromium disk cache in the blockfile format - the layout Teams uses for its Cache folder.
+
+The index file is a hash table of cache addresses. Each address points at an entry in one of
+the data_N block files, and each entry points at its key (the URL) and up to four data streams,
+which live either in a block file or in an external f_XXXXXX file. Stream 0 holds the HTTP
+response headers and stream 1 holds the body, exactly as it was received (so often GZ).
+
+Nothing is read from a stream until it is asked for - entries only record where the bytes are.
+
+Layouts follow net/disk_cache/blockfile/disk_format.h and addr.h in the Chromium source.
+
+Author - James M. (yakasov)
+"""
+
+from collections import namedtuple
+from os.path import isfile, join
+import mmap
+import re
+import struct
+
+INDEX_FILE = 'index'
+INDEX_MAGIC = 0xC103CAC3
+BLOCK_MAGIC = 0xC104CAC3
+INDEX_HEADER = struct.Struct('<IIiiiiIiii') # magic, version, num_entries, .., table_len, ..
+INDEX_HEADER_SIZE = 368 # IndexHeader is 256 bytes, followed by 112 bytes of LruData
+INDEX_TABLE_SIZE = 0x10000 # Used when the header's table_len is 0
+BLOCK_HEADER = struct.Struct('<IIhhi') # magic, version, this_file, next_file, entry_size
+BLOCK_HEADER_SIZE = 8192 # Blocks start after the header and allocation bitmap
+ENTRY_STORE = struct.Struct('<IIIiiiQiI4i4II16xI') # Up to self_hash, the key follows
+ENTRY_KEY_OFFSET = 96
+ENTRY_BLOCK_SIZE = 256
+STREAM_COUNT = 4
+HEADERS_STREAM = 0
+BODY_STREAM = 1
+
+# Cache address bits (addr.h)
+ADDR_INITIALIZED = 0x80000000
+ADDR_FILE_TYPE = 0x70000000
+ADDR_EXTERNAL_FILE = 0x0FFFFFFF
+ADDR_NUM_BLOCKS = 0x03000000
+ADDR_FILE_SELECTOR = 0x00FF0000
+ADDR_START_BLOCK = 0x0000FFFF
+EXTERNAL = 0 # Every other file type lives in a data_N block file
+
+CacheEntry = namedtuple('CacheEntry', ['hash', 'key', 'streams'])
+CacheEntry.__doc__ = 'A cache entry - its key hash, key (URL) and a Stream (or None) per stream.'
+Stream = namedtuple('Stream', ['path', 'offset', 'size'])
+Stream.__doc__ = 'Where a data stream lives - file path, byte offset into it and length.'
+
+UNSAFE_NAME_CHARACTERS = re.compile(r'[^A-Za-z0-9._-]+')
+MAX_NAME_LENGTH = 120
+
+def is_blockfile_cache(folder):
+    """Check if a folder looks like a blockfile cache (has an index file with the right magic).
+
+    :param folder: full directory path of the cache
+    :returns:      True/False
+    """
+    try:
+        with open(join(folder, INDEX_FILE), 'rb') as f:
+            return struct.unpack('<I', f.read(4))[0] == INDEX_MAGIC
+    except (OSError, struct.error):
+        return False
+
+def iter_entries(folder):
+    """Walk the index hash table and yield every entry it can reach.
+    Broken addresses, bad chains and unreadable entries are skipped rather than raised.
+
+    :param folder: full directory path of the cache
+    :returns:      generator of CacheEntry
+    :raises ValueError: if the index file is missing or not a blockfile index
+    """
+    try:
+        with open(join(folder, INDEX_FILE), 'rb') as f:
+            index = f.read()
+    except OSError as e:
+        raise ValueError(f'No readable index file in {folder}') from e
+    if len(index) < INDEX_HEADER_SIZE or INDEX_HEADER.unpack_from(index)[0] != INDEX_MAGIC:
+        raise ValueError(f'{folder} does not have a blockfile index')
+
+    table_len = INDEX_HEADER.unpack_from(index)[7] or INDEX_TABLE_SIZE
+    table_len = min(table_len, (len(index) - INDEX_HEADER_SIZE) // 4)
+    table = struct.unpack_from(f'<{table_len}I', index, INDEX_HEADER_SIZE)
+
+    block_files = {}
+    try:
+        seen = set()
+        for addr in table:
+            while addr & ADDR_INITIALIZED and addr not in seen: # seen guards against loops
+                seen.add(addr)
+                entry, addr = _read_entry(folder, block_files, addr)
+                if entry is not None:
+                    yield entry
+    finally:
+        for _, mm in block_files.values():
+            mm.close()
+
+def read_stream(stream, size=-1):
+    """Read the bytes of a data stream.
+
+    :param stream: Stream from a CacheEntry
+    :param size:   number of bytes to read from the start of the stream, -1 for all
+    :returns:      stream contents as bytes
+    """
+    size = stream.size if size < 0 else min(size, stream.size)
+    with open(stream.path, 'rb') as f:
+        f.seek(stream.offset)
+        return f.read(size)
+
+def key_to_name(key, key_hash=None):
+    """Turn an entry key into something safe to use as a file name.
+    Keys may be prefixed with a network isolation key, so only the last URL is used.
+
+    :param key:      entry key as a string
+    :param key_hash: entry hash, appended to keep names from different URLs unique
+    :returns:        file name (no extension)
+    """
+    url = key.split()[-1] if key.strip() else 'entry'
+    url = url.split('://', 1)[-1]
+    name = UNSAFE_NAME_CHARACTERS.sub('_', url).strip('_.')[:MAX_NAME_LENGTH] or 'entry'
+    return name if key_hash is None else f'{name}_{key_hash:08x}'
+
+def _block_file(folder, block_files, selector):
+    """Return (entry_size, mmap) for data_<selector>, opening it on first use."""
+    if selector not in block_files:
+        path = join(folder, f'data_{selector}')
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, _, _, entry_size = BLOCK_HEADER.unpack_from(mm)
+        if magic != BLOCK_MAGIC or entry_size <= 0:
+            mm.close()
+            raise ValueError(f'{path} is not a block file')
+        block_files[selector] = (entry_size, mm)
+    return block_files[selector]
+
+def _locate(folder, block_files, addr, size):
+    """Turn a cache address into a Stream of the given size, or None if it doesn't resolve."""
+    if not addr & ADDR_INITIALIZED or size <= 0:
+        return None
+    if (addr & ADDR_FILE_TYPE) >> 28 == EXTERNAL:
+        path = join(folder, f'f_{addr & ADDR_EXTERNAL_FILE:06x}')
+        return Stream(path, 0, size) if isfile(path) else None
+    selector = (addr & ADDR_FILE_SELECTOR) >> 16
+    num_blocks = ((addr & ADDR_NUM_BLOCKS) >> 24) + 1
+    try:
+        entry_size, mm = _block_file(folder, block_files, selector)
+    except (OSError, ValueError, struct.error):
+        return None
+    offset = BLOCK_HEADER_SIZE + (addr & ADDR_START_BLOCK) * entry_size
+    if size > num_blocks * entry_size or offset + size > len(mm):
+        return None
+    return Stream(join(folder, f'data_{selector}'), offset, size)
+
+def _read_entry(folder, block_files, addr):
+    """Read the EntryStore at addr.
+
+    :returns: tuple of (CacheEntry or None if unreadable, address of next entry in the bucket)
+    """
+    stream = _locate(folder, block_files, addr, ENTRY_BLOCK_SIZE)
+    if stream is None:
+        return None, 0
+    _, mm = block_files[(addr & ADDR_FILE_SELECTOR) >> 16]
+    fields = ENTRY_STORE.unpack_from(mm, stream.offset)
+    key_hash, next_addr, key_len, long_key = fields[0], fields[1], fields[7], fields[8]
+    data_size, data_addr = fields[9:13], fields[13:17]
+
+    if long_key & ADDR_INITIALIZED:
+        key_stream = _locate(folder, block_files, long_key, key_len)
+        key = read_stream(key_stream) if key_stream is not None else b''
+    else: # Short keys are stored inline, and may run on into the entry's following blocks
+        num_blocks = ((addr & ADDR_NUM_BLOCKS) >> 24) + 1
+        key_len = max(0, min(key_len, num_blocks * ENTRY_BLOCK_SIZE - ENTRY_KEY_OFFSET))
+        key_start = stream.offset + ENTRY_KEY_OFFSET
+        key = mm[key_start:key_start + key_len]
+    if not key:
+        return None, next_addr
+
+    streams = tuple(_locate(folder, block_files, data_addr[i], data_size[i])
+                    for i in range(STREAM_COUNT))
+    return CacheEntry(key_hash, key.decode('utf-8', 'replace'), streams), next_addr
@@ -0,0 +1,157 @@
+"""
+Cut files out of a data file by their signature and where they end.
+
+Data files are mostly files separated by runs of null bytes, but not always - files get packed
+in with no gap, have junk in front of them, or have null runs of their own. Every signature with
+an end rule is searched for in one pass (a single compiled pattern matching all of them at once),
+and each match is followed to the exact end of its file:
+
+    PNG  - chunk length fields, up to the end of the IEND chunk
+    JPEG - segment length fields up to the scan, then the FF D9 end marker after it
+    PDF  - the last %%EOF before the next null gap (later %%EOFs are incremental updates)
+    GZ   - inflating it until the end of the member, or the end of the fragment if it is cut short
+    CFB  - the last sector its FAT says is in use (Office files, see cfb.py)
+
+Anything that doesn't follow its format (a signature that turns up by chance in other data,
+or a file that is cut off) isn't carved, and is left to be split up like any other data.
+
+Author - James M. (yakasov)
+"""
+
+import re
+import zlib
+
+from cfb import CompoundFile
+
+PNG_END_CHUNK = b'IEND'
+PNG_CHUNK_TYPE = re.compile(rb'[A-Za-z]{4}')
+JPEG_END = b'\xd9'
+JPEG_SCAN = 0xDA
+JPEG_STANDALONE = {0x01} | set(range(0xD0, 0xD8)) # Markers with no length field
+PDF_END = b'%%EOF'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+INFLATE_SCAN_SIZE = 64 * 1024 # Bytes fed to zlib at a time when looking for the end of a GZ
+
+def png_end(data, start, _limit):
+    """Return the end of a PNG by walking its chunks, or None if it isn't a whole PNG."""
+    pos = start + 8
+    while pos + 12 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        chunk_type = data[pos + 4:pos + 8]
+        if not PNG_CHUNK_TYPE.fullmatch(chunk_type):
+            return None
+        pos += 12 + length # Length, type, data and CRC
+        if chunk_type == PNG_END_CHUNK:
+            return pos if pos <= len(data) else None
+    return None
+
+def jpeg_end(data, start, _limit):
+    """Return the end of a JPEG by walking its segments, or None if it isn't a whole JPEG."""
+    pos = start + 2
+    while pos + 2 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF: # Fill byte
+            pos += 1
+        elif marker == JPEG_END[0]:
+            return pos + 2
+        elif marker in JPEG_STANDALONE:
+            pos += 2
+        elif pos + 4 > len(data):
+            return None
+        else:
+            pos += 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+            if marker == JPEG_SCAN: # Entropy coded data follows, where FF is always stuffed
+                pos = _next_jpeg_marker(data, pos)
+                if pos is None:
+                    return None
+    return None
+
+def _next_jpeg_marker(data, pos):
+    """Skip entropy coded data - FF 00 is a stuffed FF and FF D0-D7 are restart markers."""
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos == -1 or pos + 1 >= len(data):
+            return None
+        if data[pos + 1] != 0 and data[pos + 1] not in JPEG_STANDALONE:
+            return pos
+        pos += 2
+
+def pdf_end(data, start, limit):
+    """Return the end of a PDF (after its last %%EOF and line ending) before limit, or None."""
+    pos = data.rfind(PDF_END, start, limit)
+    if pos == -1:
+        return None
+    pos += len(PDF_END)
+    for ending in (b'\r\n', b'\n', b'\r'):
+        if data[pos:pos + len(ending)] == ending:
+            return pos + len(ending)
+    return pos
+
+def gz_end(data, start, limit):
+    """Return the end of a GZ member by inflating it. A member that is cut off (or turns corrupt)
+    ends at limit instead, as long as something could be expanded from it."""
+    d = zlib.decompressobj(GZIP_WBITS)
+    pos, expanded = start, False
+    try:
+        while pos < len(data) and not d.eof:
+            block = data[pos:pos + INFLATE_SCAN_SIZE]
+            tail = block
+            while tail and not d.eof:
+                expanded |= bool(d.decompress(tail, INFLATE_SCAN_SIZE)) # Only kept as a flag
+                tail = d.unconsumed_tail
+            pos += len(block) - len(d.unused_data)
+    except zlib.error:
+        pass
+    if d.eof:
+        return pos
+    return limit if expanded else None
+
+def cfb_end(data, start, _limit):
+    """Return the end of a compound file from its FAT, or None if it isn't a whole compound file."""
+    def read(offset, size):
+        return data[start + offset:start + offset + size]
+    try:
+        end = start + CompoundFile(read).end()
+    except ValueError:
+        return None
+    return end if end <= len(data) else None
+
+END_FINDERS = { # Extension: function(data, start, limit) returning where the file ends, or None
+    '.PNG': png_end,
+    '.JPEG': jpeg_end,
+    '.PDF': pdf_end,
+    '.GZ': gz_end,
+    '.OFFICE': cfb_end,
+}
+
+def compile_signatures(signatures):
+    """Compile signatures into one pattern that finds any of them in a single scan.
+
+    :param signatures: signature bytes to extension dictionary, for extensions in END_FINDERS
+    :returns:          compiled pattern
+    """
+    # Longest first, so a signature that starts with another one still matches in full
+    ordered = sorted(signatures, key=len, reverse=True)
+    return re.compile(b'|'.join(re.escape(signature) for signature in ordered))
+
+def carve(data, pattern, signatures, start, end):
+    """Find the first file between start and end that can be cut out exactly.
+    A file may run on past end (eg. over a null gap of its own), but must start before it.
+
+    :param data:       bytes-like data to search (eg. a memory map)
+    :param pattern:    pattern from compile_signatures
+    :param signatures: signature bytes to extension dictionary the pattern was compiled from
+    :param start:      offset to search from
+    :param end:        offset to stop searching at (eg. the next null gap)
+    :returns:          tuple of (start, end, extension) or None if nothing can be carved
+    """
+    match = pattern.search(data, start, end)
+    while match is not None:
+        ext = signatures[match.group()]
+        file_end = END_FINDERS[ext](data, match.start(), end)
+        if file_end is not None and file_end > match.start():
+            return match.start(), file_end, ext
+        match = pattern.search(data, match.start() + 1, end)
+    return None
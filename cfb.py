@@ -0,0 +1,241 @@
+"""
+Read Compound File Binary (OLE2) files - the container behind .DOC, .XLS, .PPT and .MSG files -
+a few sectors at a time.
+
+A compound file is a little file system in 512 (or 4096) byte sectors: a header, a FAT of
+sector chains, and a directory of storages and streams. What kind of Office file it is depends
+on the streams at the top of its directory - WordDocument, Workbook, PowerPoint Document, or the
+__substg1.0_ property streams of an Outlook message. Only the header and the directory (and the
+FAT sectors needed to follow its chain) are read to tell, however big the file is.
+
+Sector chains are followed lazily and every chain is checked for loops, so a broken or cut off
+file raises ValueError instead of hanging or reading junk.
+
+Layouts follow [MS-CFB] (Compound File Binary File Format).
+
+Author - James M. (yakasov)
+"""
+
+from collections import namedtuple
+import struct
+
+CFB_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+HEADER = struct.Struct('<8s16xHHHHH6xIIIIIIIII') # Up to the first 109 DIFAT entries
+HEADER_DIFAT = struct.Struct('<109I')
+HEADER_SIZE = 512
+DIRECTORY_ENTRY = struct.Struct('<64sHBBIII16xI16xIQ')
+BYTE_ORDER = 0xFFFE
+MAX_REGULAR_SECTOR = 0xFFFFFFFA # Anything above is ENDOFCHAIN, FREESECT and so on
+FREE_SECTOR = 0xFFFFFFFF
+NO_STREAM = 0xFFFFFFFF
+STORAGE, STREAM, ROOT = 1, 2, 5
+MAX_DIRECTORY_ENTRIES = 1 << 16 # More than any real file, stops a broken tree being walked forever
+
+MAIN_STREAMS = { # Stream at the top of the directory: extension. Earlier entries win
+    'WordDocument': '.DOC',
+    'Workbook': '.XLS',
+    'Book': '.XLS', # Excel 5/95
+    'PowerPoint Document': '.PPT',
+    '__substg1.0_1000001F': '.MSG', # Message body (Unicode)
+    '__substg1.0_1000001E': '.MSG', # Message body (ANSI)
+}
+MSG_PREFIXES = ('__substg1.0_', '__properties_version1.0') # Every Outlook message has these
+
+DirectoryEntry = namedtuple('DirectoryEntry',
+                            ['name', 'type', 'left', 'right', 'child', 'start', 'size'])
+DirectoryEntry.__doc__ = 'A storage or stream in a compound file directory.'
+
+class CompoundFile:
+    """A compound file, read through a function so it can be part of a cache file or in memory."""
+
+    def __init__(self, read):
+        """Read and check the header.
+
+        :param read: function(offset, size) returning the bytes at offset in the compound file
+                     (fewer if the file ends first)
+        :raises ValueError: if it isn't a compound file
+        """
+        self.read = read
+        header = self._read(0, HEADER_SIZE)
+        (signature, _, major_version, byte_order, sector_shift, mini_sector_shift, _, fat_sectors,
+         self.directory_start, _, self.mini_cutoff, self.minifat_start, _, self.difat_start,
+         difat_sectors) = HEADER.unpack_from(header)
+        if signature != CFB_SIGNATURE or byte_order != BYTE_ORDER or major_version not in (3, 4):
+            raise ValueError('Not a compound file')
+        if sector_shift != (9 if major_version == 3 else 12) or mini_sector_shift != 6:
+            raise ValueError('Bad compound file sector size')
+        self.sector_size = 1 << sector_shift
+        self.mini_sector_size = 1 << mini_sector_shift
+        self.per_sector = self.sector_size // 4 # Sector numbers per FAT sector
+        self.fat_sector_count = fat_sectors
+        self.difat_sector_count = difat_sectors
+        self.fat_sectors = [s for s in HEADER_DIFAT.unpack_from(header, HEADER.size)
+                            if s <= MAX_REGULAR_SECTOR][:fat_sectors]
+        self.fat = {} # FAT sector index -> tuple of next sector numbers, read as needed
+        self.directory_sectors = [] # Directory chain, followed as far as needed
+        self.directory_chain = None
+        self.minifat_sectors = None
+        self.mini_stream_sectors = None
+
+    def _read(self, offset, size):
+        data = self.read(offset, size)
+        if len(data) < size:
+            raise ValueError('Compound file is cut off')
+        return data
+
+    def _sector_offset(self, sector):
+        return (sector + 1) * self.sector_size # Sector 0 starts after the header sector
+
+    def _fat_sector(self, index):
+        """Return where the index'th FAT sector is, reading the DIFAT chain past the header."""
+        while index >= len(self.fat_sectors) and len(self.fat_sectors) < self.fat_sector_count:
+            if self.difat_start > MAX_REGULAR_SECTOR or self.difat_sector_count <= 0:
+                break
+            difat = self._read(self._sector_offset(self.difat_start), self.sector_size)
+            entries = struct.unpack(f'<{self.per_sector}I', difat)
+            self.fat_sectors.extend(s for s in entries[:-1] if s <= MAX_REGULAR_SECTOR)
+            self.difat_start, self.difat_sector_count = entries[-1], self.difat_sector_count - 1
+        if index >= min(len(self.fat_sectors), self.fat_sector_count):
+            raise ValueError('Sector past the end of the FAT')
+        return self.fat_sectors[index]
+
+    def _fat_entries(self, index):
+        """Return the next sector numbers held in the index'th FAT sector."""
+        if index not in self.fat:
+            offset = self._sector_offset(self._fat_sector(index))
+            self.fat[index] = struct.unpack(f'<{self.per_sector}I',
+                                            self._read(offset, self.sector_size))
+        return self.fat[index]
+
+    def next_sector(self, sector):
+        """Return the sector after this one in its chain."""
+        return self._fat_entries(sector // self.per_sector)[sector % self.per_sector]
+
+    def chain(self, start, next_sector=None):
+        """Follow a sector chain.
+
+        :param start:       first sector
+        :param next_sector: function returning the next sector (next_sector, or the MiniFAT's)
+        :returns:           generator of sector numbers
+        :raises ValueError: if the chain loops
+        """
+        next_sector = next_sector or self.next_sector
+        seen = set()
+        sector = start
+        while sector <= MAX_REGULAR_SECTOR:
+            if sector in seen:
+                raise ValueError('Compound file sector chain loops')
+            seen.add(sector)
+            yield sector
+            sector = next_sector(sector)
+
+    def entry(self, index):
+        """Return the index'th directory entry, following the directory chain only as needed."""
+        per_sector = self.sector_size // DIRECTORY_ENTRY.size
+        if self.directory_chain is None:
+            self.directory_chain = self.chain(self.directory_start)
+        while index // per_sector >= len(self.directory_sectors):
+            sector = next(self.directory_chain, None)
+            if sector is None:
+                raise ValueError('Directory entry past the end of the directory')
+            self.directory_sectors.append(sector)
+        offset = (self._sector_offset(self.directory_sectors[index // per_sector])
+                  + index % per_sector * DIRECTORY_ENTRY.size)
+        name, name_size, entry_type, _, left, right, child, _, start, size = \
+            DIRECTORY_ENTRY.unpack(self._read(offset, DIRECTORY_ENTRY.size))
+        name = name[:max(name_size - 2, 0)].decode('utf-16-le', 'replace') # Size counts the null
+        if self.sector_size == 512:
+            size &= 0xFFFFFFFF # Version 3 files can have junk in the high half
+        return DirectoryEntry(name, entry_type, left, right, child, start, size)
+
+    def children(self, entry):
+        """Return the entries directly inside a storage, eg. everything at the top of the root.
+
+        :param entry: storage DirectoryEntry
+        :returns:     list of DirectoryEntry
+        """
+        found, pending, seen = [], [entry.child], set()
+        while pending:
+            index = pending.pop()
+            if index == NO_STREAM:
+                continue
+            if index in seen or len(seen) >= MAX_DIRECTORY_ENTRIES:
+                raise ValueError('Compound file directory loops')
+            seen.add(index)
+            child = self.entry(index)
+            found.append(child)
+            pending.extend((child.left, child.right)) # Siblings are kept in a red-black tree
+        return found
+
+    def identify(self):
+        """Work out what kind of Office file this is from the streams at the top of its directory.
+
+        :returns: tuple of (extension or None, main stream DirectoryEntry or None)
+        """
+        root = self.entry(0)
+        if root.type != ROOT:
+            raise ValueError('Compound file has no root entry')
+        streams = {entry.name: entry for entry in self.children(root) if entry.type == STREAM}
+        for name, ext in MAIN_STREAMS.items():
+            if name in streams:
+                return ext, streams[name]
+        if any(name.startswith(MSG_PREFIXES) for name in streams):
+            return '.MSG', None
+        return None, None
+
+    def _mini_next(self, sector):
+        """Return the mini sector after this one in its chain."""
+        if self.minifat_sectors is None:
+            self.minifat_sectors = list(self.chain(self.minifat_start))
+        if sector // self.per_sector >= len(self.minifat_sectors):
+            raise ValueError('Sector past the end of the MiniFAT')
+        offset = (self._sector_offset(self.minifat_sectors[sector // self.per_sector])
+                  + sector % self.per_sector * 4)
+        return struct.unpack('<I', self._read(offset, 4))[0]
+
+    def extents(self, entry):
+        """Return where a stream's bytes are in the file, merging sectors that follow each other.
+
+        :param entry: stream DirectoryEntry
+        :returns:     list of (offset, size) in the file
+        """
+        extents = []
+        remaining = entry.size
+        if entry.size < self.mini_cutoff: # Small streams live in the mini stream's 64 byte sectors
+            if self.mini_stream_sectors is None:
+                self.mini_stream_sectors = list(self.chain(self.entry(0).start))
+            sectors, sector_size = self.chain(entry.start, self._mini_next), self.mini_sector_size
+        else:
+            sectors, sector_size = self.chain(entry.start), self.sector_size
+        for sector in sectors:
+            if remaining <= 0:
+                break
+            if sector_size == self.mini_sector_size:
+                position = sector * sector_size
+                if position // self.sector_size >= len(self.mini_stream_sectors):
+                    raise ValueError('Sector past the end of the mini stream')
+                mini_sector = self.mini_stream_sectors[position // self.sector_size]
+                offset = self._sector_offset(mini_sector) + position % self.sector_size
+            else:
+                offset = self._sector_offset(sector)
+            size = min(sector_size, remaining)
+            remaining -= size
+            if extents and sum(extents[-1]) == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + size)
+            else:
+                extents.append((offset, size))
+        if remaining > 0:
+            raise ValueError('Compound file stream is cut off')
+        return extents
+
+    def end(self):
+        """Return how long the whole compound file is, from the last sector the FAT says is in use.
+        Unlike identify, this reads every FAT sector."""
+        last = -1
+        for index in range(self.fat_sector_count):
+            used = [i for i, s in enumerate(self._fat_entries(index)) if s != FREE_SECTOR]
+            if used:
+                last = index * self.per_sector + used[-1]
+        if last < 0:
+            raise ValueError('Compound file FAT is empty')
+        return self._sector_offset(last + 1)
@@ -0,0 +1,152 @@
+"""
+The command line of file_to_extension.py - run that with a cache folder to extract it, or with
+--plan to see how its data files would be split, or --watch to keep extracting it as it changes.
+
+Usage: python file_to_extension.py [folder] [--save-path dir] [--workers N] [--output type]
+                                   [--plan | --watch] ... (see --help)
+
+Author - James M. (yakasov)
+"""
+
+from contextlib import nullcontext
+from os.path import join
+import argparse
+import json
+import mmap
+import sys
+import time
+
+import file_to_extension as fte
+from metrics import Metrics
+from segment import plan, plan_fragments, report
+from selection import Selection, parse_types
+from sinks import SINKS
+from watch import WATCH_DEBOUNCE, watch
+
+def plan_splits(source, options=None):
+    """Dry run of splitting - plan how each data file in a cache folder would be split, and
+    report the byte count it would be split at and the fragments that would make, without
+    extracting anything. Fragments are as split, before anything is carved out of them.
+    With a log, every planned fragment is logged as an event.
+
+    :param source:  full directory path of the cache
+    :param options: file_to_extension.Options, or None for the defaults (only byte_count and log
+                    are used)
+    :returns:       dictionary of data file name: report (see segment.report)
+    """
+    options = options or fte.Options()
+    fte.apply_options(options)
+    fte.METRICS = Metrics(False, log=options.log)
+    reports = {}
+    for name in fte.get_file_list(source):
+        if name not in fte.DATA_FILES:
+            continue
+        started = time.perf_counter()
+        with open(join(source, name), 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # Empty file, nothing to plan
+                continue
+        with mm:
+            split_plan = plan(mm, fte.BYTE_COUNT, fte.SPLIT_BYTE_COUNT)
+            pieces = plan_fragments(split_plan, len(mm), fte.MIN_FRAGMENT_SIZE)
+            reports[name] = {**report(split_plan, len(mm), pieces),
+                             'seconds': round(time.perf_counter() - started, 3)}
+        for offset, size in pieces:
+            fte.METRICS.event('planned', file=name, offset=offset, size=size)
+    fte.METRICS.close()
+    return reports
+
+def main(argv=None):
+    """Run the extractor from the command line.
+
+    :param argv: arguments, or None for sys.argv
+    """
+    parser = argparse.ArgumentParser(description='Extract files from a Microsoft Teams cache.')
+    parser.add_argument('folder', nargs='?', default=fte.FOLDER_PATH,
+                        help=f'cache folder to extract from (default: {fte.FOLDER_PATH})')
+    parser.add_argument('--save-path',
+                        help='folder to save to (default: Saved in the cache folder)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to extract with (default: 1)')
+    parser.add_argument('--output', choices=SINKS, default='dir',
+                        help='save to folders (default), a tar or zip archive, or a SQLite '
+                             'database')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't print a line per file, just a progress line")
+    parser.add_argument('--log', help='write every event to this file as JSON lines')
+    parser.add_argument('--read-ahead', type=int, default=fte.READ_AHEAD,
+                        help='cache files to read ahead on background threads '
+                             f'(default: {fte.READ_AHEAD})')
+    parser.add_argument('--write-behind', type=int, default=fte.WRITE_BEHIND,
+                        help='outputs to write on background threads '
+                             f'(default: {fte.WRITE_BEHIND})')
+    parser.add_argument('--io-memory', type=int, default=fte.READ_AHEAD_MEMORY // 1024 // 1024,
+                        help='most MB held by each of read ahead and write behind (default: '
+                             f'{fte.READ_AHEAD_MEMORY // 1024 // 1024})')
+    parser.add_argument('--office-streams', action='store_true',
+                        help='also save the main stream of each Office file (eg. WordDocument) '
+                             'on its own')
+    parser.add_argument('--byte-count', type=int,
+                        help='split every data file at null runs this long, instead of picking '
+                             'per file')
+    parser.add_argument('--types', type=parse_types,
+                        help='only extract these types, comma separated (eg. PNG,JPEG)')
+    parser.add_argument('--min-size', type=int,
+                        help='only extract payloads of at least this many bytes (compressed, '
+                             'for GZ)')
+    parser.add_argument('--max-size', type=int,
+                        help='only extract payloads of at most this many bytes (compressed, '
+                             'for GZ)')
+    parser.add_argument('--url', help='only extract cache entries whose URL matches this glob '
+                                      '(eg. "*/avatar/*"), needs an index or a simple cache')
+    parser.add_argument('--plan', action='store_true',
+                        help="print how each data file would be split as JSON, and don't extract "
+                             'anything')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, extracting cache files as they change (Linux only, '
+                             'Ctrl+C to stop)')
+    parser.add_argument('--debounce', type=float, default=WATCH_DEBOUNCE,
+                        help=f'seconds to gather changes for before extracting them with --watch '
+                             f'(default: {WATCH_DEBOUNCE})')
+    args = parser.parse_args(argv)
+    if args.workers > 1 and args.output in ('tar', 'zip'):
+        parser.error('--workers can only be used with --output dir or sqlite')
+
+    select = None
+    if (args.types, args.min_size, args.max_size, args.url) != (None, None, None, None):
+        select = Selection(args.types, args.min_size, args.max_size, args.url)
+
+    with open(args.log, 'w', encoding='utf-8') if args.log else nullcontext() as log_file:
+        options = fte.Options(args.save_path, args.workers, args.output, args.read_ahead,
+                              args.write_behind, args.io_memory * 1024 * 1024,
+                              args.office_streams, args.byte_count, select, None, not args.quiet,
+                              args.quiet, log_file)
+        if args.plan:
+            print(json.dumps(plan_splits(args.folder, options), indent=1))
+            sys.exit()
+        try:
+            if args.watch:
+                results = watch(args.folder, options, args.debounce)
+            else:
+                results = fte.extract(args.folder, options)
+            for _ in results:
+                pass # Every result has already been printed as an event
+        except KeyboardInterrupt:
+            if not args.watch:
+                raise
+
+    counts = fte.METRICS.counts
+    print(f'\nRead {counts["read"]} -- Wrote {counts["write"]}\
+-- Extracted {counts["extract"]} -- Skipped {counts["skip"]} -- Unchanged {counts["unchanged"]}\
+-- Deduplicated {counts["duplicate"]} ({counts["dedupe_bytes"]} bytes saved)\
+-- Filtered {counts["filtered"]}')
+    print(fte.METRICS.summary())
+    if counts['changed']:
+        average = counts['latency'] / counts['changed'] * 1000
+        print(f'Extracted {counts["changed"]} changes {average:.0f}ms after they happened '
+              'on average')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Content-addressed index of extracted files, so the same content is only stored once.
+Files are referred to by their location in the output sink (see sinks.py).
+
+Teams caches the same avatars, emoji, fonts and scripts many times over under different entries.
+The first file saved with some content is kept, and every later file with the same content is
+made a link to it instead of another copy, where the sink can link. Files are only hashed when
+another file of the same size turns up, so most outputs never need to be read back.
+
+Author - James M. (yakasov)
+"""
+
+from os.path import isfile
+import hashlib
+import os
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def new_digest():
+    """Return a new hash object - every content hash in the extractor uses this."""
+    return hashlib.blake2b(digest_size=16)
+
+def file_digest(path, offset=0, size=None):
+    """Hash a file, or a byte range of it.
+
+    :param path:   full file path
+    :param offset: byte offset to start hashing from
+    :param size:   number of bytes to hash, None for everything after offset
+    :returns:      hash as hex
+    """
+    digest = new_digest()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while size is None or size > 0:
+            chunk = f.read(HASH_CHUNK_SIZE if size is None else min(HASH_CHUNK_SIZE, size))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if size is not None:
+                size -= len(chunk)
+    return digest.hexdigest()
+
+def link_file(existing, path):
+    """Make path a hardlink to existing, replacing path if it is already there.
+
+    :param existing: full file path of the file to link to
+    :param path:     full file path of the new link
+    :returns:        True if the link was made, False if links aren't possible here
+    """
+    temp_path = f'{path}.link'
+    try:
+        os.link(existing, temp_path)
+        os.replace(temp_path, path)
+        return True
+    except OSError:
+        if isfile(temp_path):
+            os.remove(temp_path)
+        return False
+
+class ContentIndex:
+    """Every output saved so far, by size and (once it's needed) content hash."""
+
+    def __init__(self, contents=(), exists=isfile, hash_output=file_digest):
+        """Build the index.
+
+        :param contents:    iterable of (path, size, digest or None) rows, eg. from the manifest
+        :param exists:      function checking a saved file is still there (eg. a sink's exists)
+        :param hash_output: function hashing a saved file, returning None if it can't be read
+        """
+        self.exists = exists
+        self.hash_output = hash_output
+        self.paths = {}    # (size, digest) -> path of the first file with that content
+        self.unhashed = {} # size -> paths that haven't needed hashing yet
+        self.keys = {}     # path -> (size, digest or None)
+        self.sizes = set() # sizes of every hashed file
+        self.added = []    # (path, size, digest) rows added since the last take_added
+        for path, size, digest in contents:
+            self.add(path, size, digest, track=False)
+
+    def add(self, path, size, digest=None, track=True):
+        """Add a saved file to the index.
+
+        :param path:   full file path
+        :param size:   file size in bytes
+        :param digest: content hash as hex, or None to only hash it if it's ever needed
+        :param track:  include it in take_added
+        """
+        self.discard(path)
+        self.keys[path] = (size, digest)
+        if digest is None:
+            self.unhashed.setdefault(size, []).append(path)
+        else:
+            self.paths.setdefault((size, digest), path)
+            self.sizes.add(size)
+        if track:
+            self.added.append((path, size, digest))
+
+    def discard(self, path):
+        """Forget a file, eg. because it is about to be deleted or replaced."""
+        key = self.keys.pop(path, None)
+        if key is None:
+            return
+        if key[1] is None:
+            if path in self.unhashed.get(key[0], ()):
+                self.unhashed[key[0]].remove(path)
+        elif self.paths.get(key) == path:
+            del self.paths[key]
+
+    def find(self, size, digest):
+        """Look for a saved file with the same content.
+        Saved files of the same size are hashed now if they weren't already.
+
+        :param size:   content size in bytes
+        :param digest: content hash as hex, or a function returning it (only called if needed)
+        :returns:      tuple of (full file path or None, digest or None if it wasn't needed)
+        """
+        if size not in self.sizes and size not in self.unhashed:
+            return None, None
+        for path in self.unhashed.pop(size, []):
+            path_digest = self.hash_output(path) if self.exists(path) else None
+            if path_digest is None:
+                del self.keys[path]
+                continue
+            self.keys[path] = (size, path_digest)
+            self.paths.setdefault(self.keys[path], path)
+            self.sizes.add(size)
+        digest = digest() if callable(digest) else digest
+        path = self.paths.get((size, digest))
+        return (path if path is not None and self.exists(path) else None), digest
+
+    def take_added(self):
+        """Return the rows added since the last call, eg. to hand back from a worker."""
+        added, self.added = self.added, []
+        return added
+
+    def rows(self):
+        """Return every file in the index as (path, size, digest or None) rows."""
+        return [(path, size, digest) for path, (size, digest) in self.keys.items()]
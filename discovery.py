@@ -0,0 +1,138 @@
+"""
+Find the signatures of files we couldn't identify, in bounded memory, so we know which new
+HEADERS would recover the most data.
+
+The first bytes of every unknown payload are counted at each of PREFIX_LENGTHS. Each length
+keeps at most PREFIX_CAPACITY prefixes - once there are twice that many, only the most common
+are kept, and the count of the most common one dropped is added to how many files any count
+at that length could be missing (as in the Misra-Gries heavy hitters sketch). Common prefixes
+are never dropped, so however many unknown files there are, the ones worth a HEADERS entry
+are always found.
+
+A prefix that turns up more than once is reported as a candidate signature, unless most
+(CANDIDATE_SHARE) of its files are covered by longer prefixes that turn up more than once too -
+eg. with lots of unknown files starting DE AD BE EF followed by random bytes, DE AD is covered
+by DE AD BE EF, but the six byte prefixes after DE AD BE EF are all different, so DE AD BE EF
+is the candidate. A candidate that extends a shorter one only counts if it covers a fair share
+(MIN_EXTENSION_SHARE) of its files, so the same file cached twice isn't a signature of its own.
+
+Author - James M. (yakasov)
+"""
+
+PREFIX_LENGTHS = (2, 4, 6, 8) # Signature lengths to count, in bytes
+PREFIX_CAPACITY = 1024 # Prefixes kept per length, memory is bounded by twice this
+CANDIDATE_SHARE = 0.9 # Longer prefixes have to cover this share of a prefix's files to replace it
+MIN_CANDIDATE_FILES = 2 # A signature has to turn up more than once to be worth reporting
+MIN_EXTENSION_SHARE = 0.1 # Share of a shorter candidate's files a longer one has to cover
+EXAMPLES = 3 # Payload names kept per prefix
+REPORT_SIZE = 50 # Candidates in the report, most bytes first
+
+def format_signature(prefix):
+    """Lay prefix bytes out like a HEADERS key, so they can be pasted straight in."""
+    return ' '.join(f'{byte:02X}' for byte in prefix)
+
+def dump_counts(taken):
+    """Turn counts from SignatureCounter.take into something JSON can hold (eg. to merge later,
+    in another process or on another machine) - prefixes become hex, and lengths strings.
+
+    :param taken: tuple from SignatureCounter.take
+    :returns:     dictionary ready for JSON
+    """
+    prefixes, missing, files, size = taken
+    return {'prefixes': {str(length): {prefix.hex(): entry for prefix, entry in counts.items()}
+                         for length, counts in prefixes.items()},
+            'missing': {str(length): count for length, count in missing.items()},
+            'files': files, 'bytes': size}
+
+def load_counts(dumped):
+    """Turn counts from dump_counts back into what SignatureCounter.merge takes."""
+    prefixes = {int(length): {bytes.fromhex(prefix): entry for prefix, entry in counts.items()}
+                for length, counts in dumped['prefixes'].items()}
+    missing = {int(length): count for length, count in dumped['missing'].items()}
+    return prefixes, missing, dumped['files'], dumped['bytes']
+
+class SignatureCounter:
+    """Counts of unknown payload prefixes. One per process - workers hand theirs back with take."""
+
+    def __init__(self):
+        # Length -> {prefix -> [files, bytes, examples]}
+        self.prefixes = {length: {} for length in PREFIX_LENGTHS}
+        self.missing = dict.fromkeys(PREFIX_LENGTHS, 0) # Most files any count could be missing
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, header, size, name):
+        """Count an unknown payload.
+
+        :param header: at least the first max(PREFIX_LENGTHS) bytes of the payload (or all of it)
+        :param size:   payload size in bytes
+        :param name:   payload name, kept as an example
+        """
+        self.files += 1
+        self.bytes += size
+        for length in PREFIX_LENGTHS:
+            if len(header) < length:
+                break
+            self._count(length, bytes(header[:length]), 1, size, (name,))
+
+    def _count(self, length, prefix, files, size, examples):
+        counts = self.prefixes[length]
+        entry = counts.get(prefix)
+        if entry is None:
+            entry = counts[prefix] = [0, 0, []]
+        entry[0] += files
+        entry[1] += size
+        entry[2].extend(examples[:max(EXAMPLES - len(entry[2]), 0)])
+        if len(counts) > 2 * PREFIX_CAPACITY:
+            ranked = sorted(counts.items(), key=lambda item: item[1][0], reverse=True)
+            self.missing[length] += ranked[PREFIX_CAPACITY][1][0]
+            self.prefixes[length] = dict(ranked[:PREFIX_CAPACITY])
+
+    def take(self):
+        """Return everything counted so far (for merge) and start again from zero."""
+        taken = (self.prefixes, self.missing, self.files, self.bytes)
+        self.prefixes = {length: {} for length in PREFIX_LENGTHS}
+        self.missing = dict.fromkeys(PREFIX_LENGTHS, 0)
+        self.files = self.bytes = 0
+        return taken
+
+    def merge(self, taken):
+        """Add counts from take (eg. from a worker) to these."""
+        prefixes, missing, files, size = taken
+        for length, counts in prefixes.items():
+            for prefix, (prefix_files, prefix_bytes, examples) in counts.items():
+                self._count(length, prefix, prefix_files, prefix_bytes, examples)
+            self.missing[length] += missing[length]
+        self.files += files
+        self.bytes += size
+
+    def candidates(self):
+        """Return the prefixes that look like signatures, most bytes covered first.
+
+        :returns: list of dictionaries, one per candidate signature
+        """
+        found = []
+        candidate_files = {} # Candidate prefix -> files, to check longer candidates against
+        for i, length in enumerate(PREFIX_LENGTHS):
+            covered = {} # Prefix -> files covered by longer prefixes that turn up more than once
+            if i + 1 < len(PREFIX_LENGTHS):
+                for longer, (files, _, _) in self.prefixes[PREFIX_LENGTHS[i + 1]].items():
+                    if files >= MIN_CANDIDATE_FILES:
+                        covered[longer[:length]] = covered.get(longer[:length], 0) + files
+            for prefix, (files, size, examples) in self.prefixes[length].items():
+                if files < MIN_CANDIDATE_FILES or covered.get(prefix, 0) >= CANDIDATE_SHARE * files:
+                    continue
+                if any(files < MIN_EXTENSION_SHARE * candidate_files.get(prefix[:shorter], 0)
+                       for shorter in PREFIX_LENGTHS[:i]):
+                    continue
+                candidate_files[prefix] = files
+                found.append({'signature': format_signature(prefix), 'files': files, 'bytes': size,
+                              'byte_share': round(size / max(self.bytes, 1), 4),
+                              'max_missing_files': self.missing[length], 'examples': examples})
+        found.sort(key=lambda candidate: candidate['bytes'], reverse=True)
+        return found[:REPORT_SIZE]
+
+    def report(self):
+        """Return a report of the unknown payloads and their likely signatures, ready for JSON."""
+        return {'unknown_files': self.files, 'unknown_bytes': self.bytes,
+                'candidates': self.candidates()}
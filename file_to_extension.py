@@ -9,65 +9,37 @@ it will not be saved.
 Author - James M. (yakasov)
 """
 
-from os import listdir, mkdir, remove, rmdir
-from os.path import isfile, isdir, join
-from collections import Counter
-import gzip
-import shutil
-
-HEADERS = { # HEADERS must be compressed headers first, then file headers second
-    # COMPRESSED FILETYPE HEADERS BELOW
-    '1F 8B 08': '.GZ',
-    '37 7A BC AF 27 1C': '.7Z',
-    '50 4B 03 04': '.ZIP',
-    # We don't actually process 7z or zip files
-    # But we put them here so they don't get added to UNKNOWN_CODES
-    #
-    # DOCUMENT-ESQUE FILETYPE HEADERS BELOW
-    '50 4B 03 04 14 00 06 00': '.OOXML', # DOCX, PPTX, XLSX
-    'FD FF FF FF': '.OFFICE', # These files need manual checking, rules below HEADERS dic
-    '   6E 1E F0': '.PPT', #                         Prepend 0 byte   + 0x200 byte offset
-    ' F 00 E8 03': '.PPT', #                         Prepend 0 nibble + 0x200 byte offset
-    'A0 46 1D F0': '.PPT', #                                          + 0x200 byte offset
-    'EC A5 C1 00': '.DOC', #                                          + 0x200 byte offset
-    ' 9 08 10 00 00 06 05 00': '.XLS', #             Prepend 0 nibble + 0x200 byte offset
-    '25 50 44 46': '.PDF',
-    '52 00 6F 00 6F 00 74 00': '.MSG', # Outlook/Exchange message     + 0x200 byte offset
-    #
-    # MEDIA FILETYPE HEADERS BELOW
-    '89 50 4E 47 0D 0A 1A 0A': '.PNG',
-    'FF D8 FF': '.JPEG',
-    '49 44 33': '.MP3',
-    '7B 5C 72 74 66': '.RTF',
-    '47 49 46 38': '.GIF',   # Followed by 37 61 or 39 61
-    '77 4F 46 32': '.WOFF2', # Web Open Font Format 2
-    'EF BB BF 3C': '.HTML',  # Same signature for WSC
-    '3C 21': '.HTML',        # Starts with <! (for DOCTYPE)
-    #
-    # OTHER FILETYPE HEADERS BELOW
-    '6E 70 6D': '.LOG',      # npm log files
-    '22 75 73 65': '.JS',    # Fallback: these files all start with "use
-    '2F 2A': '.JS',          # Fallback: these files all start with /*
-    '7B 22': '.JSON',        # Fallback: these files all start with {
-}
-
-# Rules for .OFFICE file types:
-#
-# All the .OFFICE files are usually prepended by a 0x200 (512) byte offset
-#      00 01 02 03 04 05 06 07 08 09 10 11 12 13 14 15
-# PPT: FD FF FF FF nn nn 00 00
-# XLS: FD FF FF FF nn 00
-# or   FD FF FF FF nn 02
-# or   FD FF FF FF 20 00 00 00
-# DB : FD FF FF FF xx xx xx xx xx xx xx xx 04 00 00 00
+from os import listdir, mkdir
+from os.path import basename, isfile, isdir, join
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice
+from multiprocessing import Pool
+import json
+import mmap
+import os
+import re
+import runpy
+import zlib
+
+from blockfile import BODY_STREAM, is_blockfile_cache, iter_entries, key_to_name
+from carve import END_FINDERS, carve, compile_signatures
+from cfb import CompoundFile
+from dedupe import ContentIndex, file_digest, new_digest
+from discovery import PREFIX_LENGTHS, SignatureCounter
+from manifest import MANIFEST_NAME, Manifest
+from metrics import Metrics
+from segment import null_runs, plan
+from selection import wants_key, wants_size, wants_type
+from signatures import HEADER_OFFSETS, HEADER_WINDOW, HEADERS, classify, signature_bytes
+from simplecache import is_entry_file, read_entry
+from sinks import COPY_CHUNK_SIZE, WRITE_BEHIND_MEMORY, open_sink
 
 FOLDER_PATH = 'C:\\Users\\Work\\Desktop\\Cache'
 # Change if necessary, encode \ -> \\
 # You'll need to copy your cache elsewhere so the files can be read with correct perms
 # Default cache is at %appdata%\Microsoft\Teams\Cache
-EXTENDED_PATH = f'{FOLDER_PATH}\\Saved\\DATA'
-UNKNOWN_CODES = [] # If the header is not in HEADERS, store the first 12 characters here
-NEW_GZ_FILES = []
 DATA_FILES = ['data_0', 'data_1', 'data_2', 'data_3', 'index'] # 'data_3'
 BYTE_COUNT = 36 # 36 is good for precise splitting, 186 is fast but not 100% complete
 # The BYTE_COUNT is the length of space between data to look for
@@ -77,11 +49,102 @@ BYTE_COUNT = 36 # 36 is good for precise splitting, 186 is fast but not 100% com
 #
 # A lower count will also increase processing time as more files will be generated!
 # The lowest you should go is 29 I reckon
-
-READ_COUNT = 0
-WRITE_COUNT = 0
-EXTRACT_COUNT = 0
-SKIP_COUNT = 0
+#
+# Each data file is split at a count picked from its own null runs now (see segment.py),
+# BYTE_COUNT is only used if it has too few runs to pick one, or in watch mode.
+# Use --plan to see what each data file would be split at, and --byte-count to override it
+NON_ZERO = re.compile(rb'[^\x00]')
+MIN_FRAGMENT_SIZE = 33 # Any file less than 33 bytes is probably worthless
+
+Payload = namedtuple('Payload',
+                     ['name', 'path', 'offset', 'size', 'content', 'kind', 'chunks', 'head'],
+                     defaults=(None, None))
+Payload.__doc__ = 'Something passed between stages - a byte range of a file, or content in memory.'
+# chunks is only set once a payload is being expanded, as the generator of expanded data
+# head is the first SNIFF_SIZE bytes (or all of them, if it is shorter) if they were read ahead
+# kind is one of 'file' (loose cache file), 'entry' (index or simple cache entry body),
+# 'data' (data file to split), or 'fragment' (piece of a split data file, or a file carved from one)
+
+Result = namedtuple('Result', ['source', 'type', 'offset', 'size', 'location'])
+Result.__doc__ = 'What extract found in a payload - where it came from, its type and where it went.'
+# source, offset and size are the byte range of the cache file it came from (compressed, for GZ)
+# type is the extension without the dot (of the expanded file, for GZ) or None if it is unknown
+# location is where it was saved in the sink, or None if it wasn't (eg. unknown loose files)
+
+METRICS = Metrics() # Counters, stage times and events, see metrics.py
+UNKNOWN = SignatureCounter() # Prefixes of everything not in HEADERS, see discovery.py
+CONTENTS = ContentIndex() # Every saved file, to find duplicates with
+SINK = None # Where outputs are saved, see sinks.py
+OUTPUTS = {} # Source name -> output locations, for the manifest
+MANIFEST_UPDATES = {} # Source name -> (size, mtime, digest, outputs kept), recorded after the run
+FAILED = {} # Output location -> source name, for outputs that couldn't be saved
+
+WORKER_CHUNK_SIZE = 16 # Payloads handed to a worker at a time with --workers
+WORKER_BACKLOG = 2 # Batches waiting per worker - the cache is split no further ahead than this
+READ_AHEAD = 0 # Payloads read ahead on background threads, worth turning on for network drives
+READ_AHEAD_MEMORY = 64 * 1024 * 1024 # Most payload data held by reading ahead
+READ_AHEAD_FILE_SIZE = 1024 * 1024 # Payloads up to this size are read ahead whole, else their head
+WRITE_BEHIND = 8 # Outputs written on background threads (dir output only), 0 to write straight away
+OFFICE_STREAMS = False # Also save the main stream of Office files (eg. WordDocument) on its own
+SPLIT_BYTE_COUNT = None # Null run length to split every data file at, None to pick one per file
+OFFICE_TYPES = {'.OFFICE', '.DOC', '.XLS', '.PPT', '.MSG'} # Compound files, see cfb.py
+SELECT = None # Selection of what to extract (see selection.py), None for everything
+SHARD = None # (shard, shards) - only extract sources that hash to this shard (see batch.py)
+
+Options = namedtuple('Options', ['save_path', 'workers', 'output', 'read_ahead', 'write_behind',
+                                 'io_memory', 'office_streams', 'byte_count', 'select', 'shard',
+                                 'verbose', 'progress', 'log'],
+                     defaults=(None, 1, 'dir', READ_AHEAD, WRITE_BEHIND, READ_AHEAD_MEMORY,
+                               OFFICE_STREAMS, SPLIT_BYTE_COUNT, SELECT, SHARD, False, False, None))
+Options.__doc__ = 'How extract runs - see the command line arguments for what each one does.'
+# save_path defaults to the Saved folder in the cache folder, and io_memory is in bytes
+# log is an open text file to write events to as JSON lines, verbose prints a line per event
+
+SNIFF_SIZE = 4096 # Only this many bytes are read to classify a file, must be >= HEADER_WINDOW
+INFLATE_CHUNK_SIZE = 256 * 1024 # Most expanded data held in memory per GZ file
+GZIP_WBITS = 16 + zlib.MAX_WBITS # Tells zlib to expect a GZ header and trailer
+GZ_SIGNATURE = b'\x1f\x8b\x08'
+
+CARVE_SIGNATURES = {signature_bytes(hex_code): ext for hex_code, ext in HEADERS.items()
+                    if ext in END_FINDERS and hex_code not in HEADER_OFFSETS}
+CARVE_PATTERN = compile_signatures(CARVE_SIGNATURES)
+CARVABLE = {None, *END_FINDERS} # Fragments starting with anything else are kept whole
+
+def could_be_selected(ext):
+    """Check if a payload sniffed as ext could still be extracted under SELECT.
+    GZ payloads are only judged once expanded, and Office files once their directory is read.
+
+    :param ext: extension from classify, or None
+    :returns:   True/False
+    """
+    if ext == '.GZ':
+        return True
+    if ext in OFFICE_TYPES:
+        return any(wants_type(SELECT, office_ext) for office_ext in OFFICE_TYPES)
+    return wants_type(SELECT, ext)
+
+def fragment_selected(fragment):
+    """Check the size and signature of a data file fragment against SELECT, before it is copied."""
+    if SELECT is None:
+        return True
+    if wants_size(SELECT, len(fragment)) and could_be_selected(classify(fragment[:HEADER_WINDOW])):
+        return True
+    METRICS.add('filtered')
+    return False
+
+def in_shard(source):
+    """Check if a source (cache file or index entry path) is in SHARD. Sources are spread over
+    shards by a hash of their path, so they land in the same shard on every run and machine.
+
+    :param source: path of the cache file, or the cache folder joined with the entry's name
+    :returns:      True/False
+    """
+    if SHARD is None:
+        return True
+    shard, shards = SHARD
+    digest = new_digest()
+    digest.update(source.encode('utf-8', 'surrogateescape'))
+    return int(digest.hexdigest()[:16], 16) % shards == shard
 
 def get_file_list(path):
     """Return list of all file names in directory.
@@ -91,258 +154,847 @@ def get_file_list(path):
     """
     return [f for f in listdir(path) if isfile(join(path, f))]
 
-def get_file(path):
-    """Return file contents for given file.
+def read_payload_chunks(payload):
+    """Yield the bytes of a payload a chunk at a time - from memory if we have them, else its file.
 
-    :param path: full file path including extension
-    :returns:    file contents as bytes
+    :param payload: Payload to read
+    :returns:       generator of bytes-like chunks
+    """
+    if payload.content is not None:
+        view = memoryview(payload.content)
+        for start in range(0, len(view), COPY_CHUNK_SIZE):
+            yield view[start:start + COPY_CHUNK_SIZE]
+        return
+    with open(payload.path, 'rb') as f:
+        METRICS.add('read')
+        f.seek(payload.offset)
+        remaining = payload.size
+        while remaining is None or remaining > 0:
+            size = COPY_CHUNK_SIZE if remaining is None else min(COPY_CHUNK_SIZE, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+def inflate_chunks(chunks, first_size=INFLATE_CHUNK_SIZE):
+    """Expand GZ data a chunk at a time, never holding more than INFLATE_CHUNK_SIZE of output.
+    Concatenated GZ members (optionally padded with null bytes) are expanded one after another.
+    Anything after the last member is ignored, and a truncated or corrupt member just ends the
+    output early - whatever was expanded before that is kept.
+
+    :param chunks:     iterable of GZ data as bytes-like chunks
+    :param first_size: most expanded data in the first chunk, eg. just enough to classify it by
+    :returns:          generator of expanded bytes chunks
+    """
+    d = zlib.decompressobj(GZIP_WBITS)
+    pending = b''
+    size = first_size
+    for data in chunks:
+        pending += data
+        while True:
+            if d.eof: # Previous member finished, see if another one follows
+                pending = pending.lstrip(b'\x00')
+                if len(pending) < len(GZ_SIGNATURE):
+                    break # Need more data to tell
+                if not pending.startswith(GZ_SIGNATURE):
+                    return # Trailing junk
+                d = zlib.decompressobj(GZIP_WBITS)
+            try:
+                out = d.decompress(pending, size)
+            except zlib.error:
+                return # Corrupt from here on
+            pending = d.unused_data if d.eof else d.unconsumed_tail
+            if out:
+                yield out
+            if not pending and len(out) < size:
+                break
+            if out:
+                size = INFLATE_CHUNK_SIZE
+
+def count_chunks(name, chunks):
+    """Pass chunks on, adding their length to a METRICS counter.
+
+    :param name:   counter name
+    :param chunks: iterable of bytes-like chunks
+    :returns:      generator of the same chunks
     """
-    with open(path, 'rb') as f:
-        global READ_COUNT
-        READ_COUNT += 1
-        return f.read()
+    for chunk in chunks:
+        METRICS.add(name, len(chunk))
+        yield chunk
+
+def dedupe_output(location, size, digest):
+    """Check an output (saved, or about to be) against everything saved before it.
+    If the same content was already saved, the output is made a link to it in the sink.
+
+    :param location: sink location of the output
+    :param size:     content size in bytes
+    :param digest:   content hash as hex, or a function returning it (only called if needed)
+    :returns:        True if the output is now a link to an earlier copy
+    """
+    existing, digest = CONTENTS.find(size, digest)
+    if existing is not None and existing != location and SINK.link(existing, location):
+        METRICS.add('dedupe_bytes', size)
+        METRICS.event('duplicate', f'{location} is a duplicate of {existing}, linked',
+                      location=location, existing=existing, size=size)
+        return True
+    CONTENTS.add(location, size, digest)
+    return False
+
+def save_file(location, chunks):
+    """Save content to the sink. The content is hashed as it is written,
+    and if it turns out to be a duplicate it is swapped for a link to the earlier copy.
+
+    :param location: sink location of the output (file yet to be created)
+    :param chunks:   file content as an iterable of bytes chunks to be written
+    """
+    if not SINK.exists(location): # We don't need to rewrite the file if it already exists
+        try:
+            size, digest = SINK.write(location, chunks)
+            METRICS.add('write')
+            if not dedupe_output(location, size, digest):
+                METRICS.add('bytes_out', size)
+                METRICS.event('new_file', f'NEW FILE: {location}', location=location, size=size)
+        except PermissionError:
+            forget_output(location)
+            METRICS.event('error',
+                          'PermissionError: File save failed, file is likely locked / in use.',
+                          location=location)
+        except FileNotFoundError:
+            forget_output(location)
+    else:
+        METRICS.event('skip', f'{location} already exists, skipping...', location=location)
 
-def unzip_gz(path):
-    """Use gzip to read the extracted contents of a compressed GZ file.
+def copy_file(src, location, offset=0, size=None):
+    """Copy a cache file to the sink, without reading it if the sink allows.
+    If something of the same size was already saved, the payload is hashed first and
+    duplicates are linked to the earlier copy instead of being written at all.
 
-    :param path: full file path including extension
-    :returns:    file contents as bytes + two null (0x00) bytes as a trailer
+    :param src:      full file path of the cache file
+    :param location: sink location of the output (file yet to be created)
+    :param offset:   byte offset in src where the payload starts
+    :param size:     payload length, None for everything after offset
     """
-    print(f'Unzipping .gz at {path}.gz...')
-    try:
-        with gzip.open(path, 'rb') as f:
-            global EXTRACT_COUNT
-            EXTRACT_COUNT += 1
-            return f.read() + b'\x00\x00'
-    except (FileNotFoundError, EOFError, gzip.BadGzipFile):
-        return ''
-
-def save_file(path, content, extension):
-    """Save content to path as matching extension.
-
-    :param path:      full file path excluding extension (file yet to be created)
-    :param content:   file content as bytes to be written
-    :param extension: extension to be appended to file path
-    """
-    path_with_extension = f'{path}{extension}'
-    if not isfile(path_with_extension): # We don't need to rewrite the file if it already exists
+    if not SINK.exists(location): # We don't need to rewrite the file if it already exists
         try:
-            with open(path_with_extension, 'wb') as f:
-                f.write(content)
-                f.close()
-                global WRITE_COUNT
-                WRITE_COUNT += 1
-            print(f'NEW FILE: {path_with_extension}')
+            if size is None:
+                size = os.stat(src).st_size - offset
+            if not dedupe_output(location, size, partial(file_digest, src, offset, size)):
+                digest = SINK.copy(location, src, offset, size)
+                if digest is not None: # The sink hashed it anyway
+                    CONTENTS.add(location, size, digest)
+                METRICS.add('bytes_out', size)
+                METRICS.event('new_file', f'NEW FILE: {location}', location=location, size=size)
+            METRICS.add('write')
         except PermissionError:
-            print('PermissionError: File save failed, file is likely locked / in use.')
+            forget_output(location)
+            METRICS.event('error',
+                          'PermissionError: File save failed, file is likely locked / in use.',
+                          location=location)
         except FileNotFoundError:
-            pass
+            forget_output(location)
     else:
-        print(f'{path_with_extension} already exists, skipping...')
-        global SKIP_COUNT
-        SKIP_COUNT += 1
+        METRICS.event('skip', f'{location} already exists, skipping...', location=location)
 
-def save_split_file(fname, path, content, i):
+def save_split_file(location, content):
     """Save content from split data file - no extension.
 
-    :param fname:   original un-split data file name
-    :param path:    full directory path (...path\\Saved)
-    :param content: file content as hex to be converted to bytes and written
-    :param i:       unique number to identify new split data files
+    :param location: sink location of the output (file yet to be created)
+    :param content:  file content as bytes
     """
-    path_with_extension = f'{path}\\DATA\\{fname}_{i}'
-    if not isfile(path_with_extension):
+    if not SINK.exists(location):
         try:
-            with open(path_with_extension, 'wb') as f:
-                if len(content) % 2 == 1:
-                    f.write(bytes.fromhex(f'{content}0'))
-                else:
-                    f.write(bytes.fromhex(content))
-                f.close()
-                global WRITE_COUNT
-                WRITE_COUNT += 1
-            print(f'NEW DATA FILE: {path_with_extension}')
+            SINK.write(location, [content])
+            METRICS.add('write')
+            METRICS.add('bytes_out', len(content))
+            METRICS.event('new_data_file', f'NEW DATA FILE: {location}', location=location,
+                          size=len(content))
         except (PermissionError, FileNotFoundError):
-            pass
+            forget_output(location)
     else:
-        global SKIP_COUNT
-        SKIP_COUNT += 1
-        print(f'{path_with_extension} already exists, skipping...')
+        METRICS.event('skip', f'{location} already exists, skipping...', location=location)
 
+def output_unknown_headers(save_path):
+    """Write a JSON report of the signatures of everything we couldn't identify.
+    This lets us identify common signatures we've missed in the HEADERS dictionary.
 
-def check_directories(check_folder_path):
-    """Check if certain directories already exist. If not, create them.
-
-    :param check_folder_path: full directory path (...path\\Saved)
+    :param save_path: full directory path (...path\\Saved)
     """
-    if not isdir(check_folder_path):
-        mkdir(check_folder_path)
-        print(f'Couldn\'t find {check_folder_path}! Creating new directory...')
-    if not isdir(f'{check_folder_path}\\DATA') and '\\Saved\\DATA' not in check_folder_path:
-        mkdir(f'{check_folder_path}\\DATA')
-    for _, extension in HEADERS.items():
-        check_ext_path = f'{check_folder_path}\\{extension.replace(".", "")}'
-        if not isdir(check_ext_path):
-            mkdir(check_ext_path)
-            print(f'Couldn\'t find {check_ext_path}! Creating new directory...')
-
-def check_validity(content, sig):
-    """Compare file headers and make sure the we're not looking at a file
-    that already has the correct extension.
-
-    :param content: file contents as bytes
-    :param sig:     signature from HEADERS to check against file contents
-    :return:        True/False if signature is present at start of file
+    with open(join(save_path, 'unknown_codes.json'), 'w', encoding='utf-8') as f:
+        json.dump(UNKNOWN.report(), f, indent=1)
+
+def find_fragments(full_path, start=0, end=None, byte_count=None):
+    """Memory-map a data file and yield the pieces between runs of null (0x00) bytes, as long as
+    the byte count picked for it from its own null runs (see segment.py), or SPLIT_BYTE_COUNT if
+    set.
+    Leading null bytes are stripped from each piece.
+    Pieces that don't start with something to keep whole are scanned for files that can be
+    cut out exactly (see carve.py) - each of these is a piece of its own, with whatever was
+    around it left as pieces either side. Carved files can run on over null gaps of their own.
+    Each piece is a memoryview slice of the map, so it is only valid until the next one is yielded.
+
+    :param full_path:  full file path of the data file
+    :param start:      offset to start splitting from (eg. the end of the last split of a
+                       growing file)
+    :param end:        offset to stop splitting at, None for the end of the file
+    :param byte_count: shortest null run to split at, without planning - eg. for a growing file,
+                       which has to be split the same way every time
+    :returns:          generator of (offset, memoryview) tuples
     """
-    try:
-        return content.hex()[:len(sig)].upper() == sig
-    except AttributeError:
-        return False
-
-def remove_empty_directories(path):
-    """Look through the created directories and delete any that are empty.
-
-    :param path: full directory path
+    with open(full_path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # Empty file, nothing to map
+            return
+    with mm, memoryview(mm) as view:
+        pos, limit = start, len(mm) if end is None else min(end, len(mm))
+        if byte_count is None:
+            split_plan = plan(mm, BYTE_COUNT, SPLIT_BYTE_COUNT)
+            METRICS.event('plan', f'Splitting {basename(full_path)} at '
+                          f'{split_plan.byte_count}+ null bytes',
+                          file=basename(full_path), byte_count=split_plan.byte_count,
+                          picked=split_plan.picked)
+            gaps = split_plan.gaps
+        else:
+            gaps = null_runs(mm, byte_count, start, limit)
+        for gap_start, gap_end in chain(gaps, [(limit, limit)]):
+            if pos >= limit:
+                break
+            if gap_end <= pos:
+                continue # Already past it, eg. in a file that was carved out
+            start, end = pos, min(max(gap_start, pos), limit)
+            pos = max(min(gap_end, limit), end)
+            first = NON_ZERO.search(mm, start, end)
+            if (first is not None
+                    and classify(mm[first.start():first.start() + HEADER_WINDOW]) in CARVABLE):
+                while start < end and (
+                        carved := carve(mm, CARVE_PATTERN, CARVE_SIGNATURES, start, end)):
+                    yield from _fragment(mm, view, start, carved[0])
+                    yield from _fragment(mm, view, carved[0], carved[1], min_size=1)
+                    start = carved[1]
+                pos = max(pos, start) # A carved file can end past the gap
+            if start < end:
+                yield from _fragment(mm, view, start, end)
+
+def _fragment(mm, view, start, end, min_size=MIN_FRAGMENT_SIZE):
+    """Yield the slice between start and end with leading nulls stripped, if it's big enough."""
+    first = NON_ZERO.search(mm, start, end)
+    if first is not None and end - first.start() >= min_size:
+        fragment = view[first.start():end]
+        yield first.start(), fragment
+        fragment.release()
+
+def read_payload(payload, size=-1):
+    """Return the bytes of a payload, from memory if we have them, else from its file.
+
+    :param payload: Payload to read
+    :param size:    number of bytes to read from the start of the payload, -1 for all
+    :returns:       payload contents as bytes
+    """
+    if payload.content is not None:
+        return bytes(payload.content[:size] if size >= 0 else payload.content)
+    head = payload.head
+    if head is not None and (0 <= size <= len(head) or len(head) < SNIFF_SIZE):
+        return head[:size] if size >= 0 else head
+    if payload.size is not None and (size < 0 or size > payload.size):
+        size = payload.size
+    with open(payload.path, 'rb') as f:
+        METRICS.add('read')
+        f.seek(payload.offset)
+        return f.read(size)
+
+def payload_reader(payload):
+    """Return a function reading any byte range of a payload - from memory if we have it
+    (or its head covers the range), else from its file.
+
+    :param payload: Payload to read
+    :returns:       function(offset, size) returning up to size bytes from offset in the payload
+    """
+    def read(offset, size):
+        if payload.size is not None:
+            size = max(min(size, payload.size - offset), 0)
+        if payload.content is not None:
+            return bytes(payload.content[offset:offset + size])
+        if payload.head is not None and offset + size <= len(payload.head):
+            return payload.head[offset:offset + size]
+        with open(payload.path, 'rb') as f:
+            METRICS.add('read')
+            f.seek(payload.offset + offset)
+            return f.read(size)
+    return read
+
+def read_extents(payload, extents):
+    """Yield byte ranges of a payload a chunk at a time.
+
+    :param payload: Payload to read
+    :param extents: list of (offset, size) in the payload
+    :returns:       generator of bytes chunks
     """
-    for _, extension in HEADERS.items():
-        check_ext_path = f'{path}\\{extension.replace(".", "")}'
+    read = payload_reader(payload)
+    for offset, size in extents:
+        for start in range(offset, offset + size, COPY_CHUNK_SIZE):
+            yield read(start, min(COPY_CHUNK_SIZE, offset + size - start))
+
+def loose_payload(folder, name):
+    """Return a Payload for a cache file that isn't a data file. Simple cache entries (see
+    simplecache.py) are just their body, named after their URL like index entries - anything
+    else (or an entry that can't be read) is the whole file.
+
+    :param folder: full directory path of the cache
+    :param name:   cache file name
+    :returns:      Payload, or None for an entry with no body or anything SELECT leaves out
+    """
+    path = join(folder, name)
+    if is_entry_file(name):
         try:
-            if len(listdir(check_ext_path)) == 0:
-                rmdir(check_ext_path)
-                print(f'{check_ext_path} is empty, deleting...')
-        except FileNotFoundError:
-            pass
-
-def output_unknown_headers():
-    """Look through UNKNOWN_CODES and output the list into a file.
-    This lets us identify common signatures we've missed in the HEADERS dictionary.
+            entry = read_entry(path)
+        except ValueError:
+            entry = None
+        if entry is not None:
+            body = entry.streams[BODY_STREAM]
+            if body is None:
+                return None
+            return entry_payload(entry, body)
+    size = os.stat(path).st_size
+    if not (wants_size(SELECT, size) and wants_key(SELECT, None)):
+        METRICS.add('filtered')
+        return None
+    METRICS.add('bytes_in', size)
+    return Payload(name, path, 0, size, None, 'file')
+
+def entry_payload(entry, body):
+    """Return a Payload for the body of an index or simple cache entry.
+
+    :param entry: CacheEntry
+    :param body:  Stream of the entry's body
+    :returns:     Payload, or None if SELECT leaves it out
+    """
+    if not (wants_size(SELECT, body.size) and wants_key(SELECT, entry.key)):
+        METRICS.add('filtered')
+        return None
+    METRICS.add('bytes_in', body.size)
+    return Payload(key_to_name(entry.key, entry.hash), body.path, body.offset, body.size, None,
+                   'entry')
+
+def cache_source(folder):
+    """First stage: yield a Payload for everything in the cache folder worth looking at.
+    If the cache has its index, every entry's body comes from that and the files it covers
+    are left out - otherwise the data files are passed on to be split. Simple cache entries
+    are passed on as their body, see loose_payload. Anything SELECT leaves out by its size or URL
+    is dropped here, before it is read - data files have no URL, so they are only split without one.
+    With SHARD, only the cache files and index entries in the shard are passed on.
+
+    :param folder: full directory path of the cache
+    :returns:      generator of Payload
+    """
+    indexed_files = set()
+    if is_blockfile_cache(folder):
+        indexed_files.update(DATA_FILES)
+        for entry in iter_entries(folder):
+            indexed_files.update(basename(s.path) for s in entry.streams if s is not None)
+            body = entry.streams[BODY_STREAM]
+            if body is None or not in_shard(join(folder, key_to_name(entry.key, entry.hash))):
+                continue
+            if (payload := entry_payload(entry, body)) is not None:
+                yield payload
+    for file_path in get_file_list(folder):
+        if file_path in indexed_files or not in_shard(join(folder, file_path)):
+            continue
+        if file_path in DATA_FILES:
+            if not wants_key(SELECT, None):
+                continue
+            size = os.stat(join(folder, file_path)).st_size
+            METRICS.add('bytes_in', size)
+            yield Payload(file_path, join(folder, file_path), 0, size, None, 'data')
+        elif (payload := loose_payload(folder, file_path)) is not None:
+            yield payload
+
+def split_stage(payloads):
+    """Split each data file into fragments, carving out any files that can be found exactly.
+    Fragments are only byte ranges of the data file, nothing is copied until we know what they are -
+    and fragments SELECT leaves out are never copied at all.
+
+    :param payloads: generator of Payload
+    :returns:        generator of Payload
+    """
+    for payload in payloads:
+        if payload.kind != 'data':
+            yield payload
+            continue
+        for i, (offset, fragment) in enumerate(find_fragments(payload.path), 1):
+            if not fragment_selected(fragment):
+                continue
+            # The head is already mapped, so keep it - classifying won't have to open the file again
+            yield Payload(f'{payload.name}_{i}', payload.path, offset, len(fragment), None,
+                          'fragment', head=bytes(fragment[:SNIFF_SIZE]))
+
+def payload_digest(payload):
+    """Hash the contents of a payload.
+
+    :param payload: Payload to hash
+    :returns:       hash as hex
+    """
+    digest = new_digest()
+    for chunk in read_payload_chunks(payload):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def manifest_stage(payloads, manifest, kinds):
+    """Drop payloads that are the same as when the manifest last saw them.
+    Whole files are compared by size and modified time first, and only hashed if those changed.
+    So are simple cache entries, as each one has a file of its own. Other payloads that are part
+    of a file are compared by size and hash. Anything that did change
+    has its old outputs removed, so they can be written again.
+    With SELECT, only part of each source is extracted, so nothing is checked (see update_manifest).
+
+    :param payloads: generator of Payload
+    :param manifest: Manifest from the last run
+    :param kinds:    payload kinds to check, anything else is passed straight on
+    :returns:        generator of Payload
+    """
+    for payload in payloads:
+        if payload.kind not in kinds or SELECT is not None:
+            yield payload
+            continue
+        stat = os.stat(payload.path)
+        whole = payload.offset == 0 and payload.size in (None, stat.st_size)
+        if whole or is_entry_file(basename(payload.path)):
+            size, mtime = stat.st_size, stat.st_mtime
+        else:
+            size, mtime = payload.size, None
+        previous = manifest.get(payload.name)
+        if (previous is not None and mtime is not None
+                and (previous.size, previous.mtime) == (size, mtime)):
+            METRICS.add('unchanged')
+            continue
+        # Whole files are only hashed to check a change, and a changed data file gets split so
+        # each of its fragments can be checked instead
+        digest = None
+        if payload.kind != 'data' and (mtime is None or previous is not None):
+            digest = payload_digest(payload)
+        if (previous is not None and digest is not None
+                and (previous.size, previous.digest) == (size, digest)):
+            METRICS.add('unchanged')
+            MANIFEST_UPDATES[payload.name] = (size, mtime, digest, previous.outputs)
+            continue
+        if previous is not None:
+            for output in previous.outputs:
+                CONTENTS.discard(output)
+                SINK.remove(output)
+        MANIFEST_UPDATES[payload.name] = (size, mtime, digest, [])
+        yield payload
+
+def update_manifest(manifest):
+    """Record every source checked this run, with the outputs it produced.
+    Nothing is recorded with SELECT, so a later run without one still extracts everything
+    (anything already saved is skipped). Sources with an output that couldn't be saved aren't
+    recorded either, and nor are the data files their fragments came from, so the next run
+    tries them again.
+
+    :param manifest: Manifest to record into
+    """
+    failed = set(FAILED.values())
+    failed.update({source.rpartition('_')[0] for source in failed} & set(DATA_FILES))
+    if SELECT is not None:
+        MANIFEST_UPDATES.clear()
+    for source, (size, mtime, digest, outputs) in MANIFEST_UPDATES.items():
+        if source not in failed:
+            manifest.record(source, size, mtime, digest, outputs + OUTPUTS.get(source, []))
+    MANIFEST_UPDATES.clear()
+    OUTPUTS.clear()
+    FAILED.clear()
+
+def prefetch_payload(payload, whole):
+    """Read a payload ahead of time. This runs on a read-ahead thread.
+
+    :param payload: Payload to read
+    :param whole:   read all of it if it is no bigger than READ_AHEAD_FILE_SIZE, else just the head
+    :returns:       Payload with its content or head filled in (unchanged if it can't be read yet)
     """
-    UNKNOWN_CODES.sort()
-    with open(f'{FOLDER_PATH}\\Saved\\unknown_codes.json', 'wb') as f:
-        f.write(str(Counter(UNKNOWN_CODES)).strip('Counter()').encode())
-        f.close()
-
-def split_hex_files(fname, path, content):
-    """Split file by hex whitespace to create multiple smaller files.
-
-    :param fname:   original un-split data file name
-    :param path:    full directory path (...path\\Saved)
-    :param content: file content as bytes
-    """
-    split_files = content.hex().split('00' * BYTE_COUNT) # Brute force method
-    i = 0
-    for file in split_files:
-        file = file.lstrip('0') # Only strip from start of hex string
-        if len(file) > 64: # Any file less than 128 bytes is probably worthless
-            i += 1
-            save_split_file(fname, path, file, i)
-
-def move_data_files():
-    """Move files created when unpacking data files to main Saved directory."""
-    data_folder_paths = listdir(f'{EXTENDED_PATH}\\Saved')
-    for path in data_folder_paths:
+    if payload.content is not None:
+        return payload
+    try:
+        with open(payload.path, 'rb') as f:
+            size = payload.size
+            if size is None:
+                size = os.fstat(f.fileno()).st_size - payload.offset
+            f.seek(payload.offset)
+            if whole and size <= READ_AHEAD_FILE_SIZE:
+                return payload._replace(content=f.read(size))
+            return payload._replace(head=f.read(min(size, SNIFF_SIZE)))
+    except OSError:
+        return payload # Left for the stage that reads it to deal with
+
+def read_ahead_stage(payloads):
+    """Read the next READ_AHEAD payloads on background threads while earlier ones are extracted,
+    so waiting on slow (eg. network) storage overlaps with the work instead of adding to it.
+    Small payloads are read whole, as long as that keeps under READ_AHEAD_MEMORY - anything
+    else only has its head read, and is copied from its file when it is saved. With types to
+    SELECT, only heads are read, as most payloads won't be saved.
+
+    :param payloads: generator of Payload
+    :returns:        generator of Payload, in the same order
+    """
+    if READ_AHEAD <= 0:
+        yield from payloads
+        return
+    payloads = iter(payloads)
+    pending = deque() # (future, bytes set aside for it)
+    reserved = 0
+    whole = SELECT is None or SELECT.types is None
+    with ThreadPoolExecutor(READ_AHEAD) as pool:
+        while True:
+            payload = next(payloads, None)
+            if payload is not None:
+                fits = whole and reserved + READ_AHEAD_FILE_SIZE <= READ_AHEAD_MEMORY
+                held = READ_AHEAD_FILE_SIZE if fits else 0
+                pending.append((pool.submit(prefetch_payload, payload, held > 0), held))
+                reserved += held
+                if len(pending) < READ_AHEAD:
+                    continue
+            if not pending:
+                return
+            future, held = pending.popleft()
+            read = future.result()
+            if read.content is not None or read.head is not None:
+                METRICS.add('read')
+            yield read
+            reserved -= held
+
+def classify_stage(payloads):
+    """Sniff the header of each payload. Office files are told apart by their compound file
+    directory, and with OFFICE_STREAMS their main stream is passed on too, as a STREAM payload.
+    Anything SELECT leaves out by its type is dropped here, so it is never copied.
+
+    :param payloads: generator of Payload
+    :returns:        generator of (Payload, extension or None)
+    """
+    for payload in payloads:
+        ext = classify(read_payload(payload, SNIFF_SIZE))
+        if ext is not None and payload.kind == 'file' and ext in payload.name.upper():
+            ext = None # Already has its extension
+        if not could_be_selected(ext):
+            METRICS.add('filtered')
+            continue
+        if ext not in OFFICE_TYPES:
+            yield payload, ext
+            continue
         try:
-            data_file_paths = listdir(f'{EXTENDED_PATH}\\Saved\\{path}')
-        except NotADirectoryError:
-            data_file_paths = [path] # If NotADirectory, it must be a file
-        for file in data_file_paths:
-            if isfile(f'{EXTENDED_PATH}\\Saved\\{path}\\{file}') and \
-            not isfile(f'{FOLDER_PATH}\\Saved\\{path}\\{file}'):
-                shutil.move(
-                    f'{EXTENDED_PATH}\\Saved\\{path}\\{file}', f'{FOLDER_PATH}\\Saved\\{path}')
-
-def recover_gz_files(path_to_use, file_content, file_name):
-    """Some split up data files are files with a bunch of junk data, then a valid GZ file signature.
-    If this is the case, we should try and recover the file.
-
-    :param path_to_use:  full directory path
-    :param file_content: file content as bytes
-    :param file_name:    file name
-    """
-    try: # See if there's a GZ file signature that hasn't been split properly
-        gz_index = file_content.index(bytes(b'\x1f\x8b\x08'))
-        save_file(f'{path_to_use}\\{file_name}', file_content[gz_index:] + \
-            b'\x00\x00', '_GZ') # Add two null (0x00) bytes as trailer
-        NEW_GZ_FILES.append(f'{file_name}_GZ')
-    except ValueError:
-        pass
-
-def cleanup_js_files(path_to_use, file_content, full_path):
-    """A lot of split data files end up being junk data combined with a URL to an online JS file.
-    These are essentially useless to us, so we can safely delete them.
-
-    :param path_to_use:  full directory path
-    :param file_content: file content as bytes
-    :param full_path:    full file path (essentially path_to_use\\file_name from above)
-    """
-    try: # Remove all files ending in .js from the DATA folder
-         # This only affects files with the incorrect file signatures
-        if path_to_use == EXTENDED_PATH and file_content[-3:].hex() == '2e6a73':
-            remove(full_path)
-    except (AttributeError, FileNotFoundError):
-        pass
-
-def main(path_to_use):
-    """Main function. We gotta run it thrice!
-
-    :param path_to_use: full directory path to folders to read (essentially our root folder to use)
-    """
-    for file_path in FILE_LIST:
-        hex_code_found = False
-        full_path = f'{path_to_use}\\{file_path}'
-        save_path = f'{path_to_use}\\Saved'
-        check_directories(save_path)
-        file_content = get_file(full_path)
-
-        if file_path in DATA_FILES and path_to_use == FOLDER_PATH:
-            # Only run this on the first expand
-            split_hex_files(file_path, save_path, file_content)
-
-        for hex_code, ext in HEADERS.items():
-            if check_validity(file_content, hex_code.replace(' ', '')) and \
-            (ext not in file_path.upper() or FILE_LIST == NEW_GZ_FILES):
-                hex_code_found = True
-                if ext == '.GZ':
-                    file_content = unzip_gz(full_path)
-                else:
-                    save_path += f'\\{ext.replace(".", "")}\\{file_path}'
-                    save_file(save_path, file_content, ext)
-                    if path_to_use == EXTENDED_PATH:
-                        remove(full_path)
+            office = CompoundFile(payload_reader(payload))
+            office_ext, stream = office.identify()
+            extents = office.extents(stream) if OFFICE_STREAMS and stream is not None else None
+        except ValueError: # Not a readable compound file after all, so go by the offset rules
+            office_ext, extents = None, None
+        if not wants_type(SELECT, office_ext or ext):
+            METRICS.add('filtered')
+            continue
+        yield payload, office_ext or ext
+        if extents is not None:
+            yield payload._replace(chunks=read_extents(payload, extents)), '.STREAM'
+
+def decompress_stage(items):
+    """Expand GZ payloads as they are saved, and classify what comes out from the first
+    (HEADER_WINDOW long) expanded chunk. Only one chunk is held in memory at a time, and
+    nothing more is expanded if SELECT leaves out what the first chunk turns out to be.
+
+    :param items: generator of (Payload, extension or None)
+    :returns:     generator of (Payload, extension or None)
+    """
+    for payload, ext in items:
+        if ext == '.GZ':
+            METRICS.event('inflate', f'Unzipping .gz at {payload.name}...', payload=payload.name)
+            chunks = count_chunks('gz_in', read_payload_chunks(payload))
+            chunks = METRICS.timed('inflate', inflate_chunks(chunks, HEADER_WINDOW))
+            chunks = count_chunks('gz_out', chunks)
+            head = b''
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= HEADER_WINDOW:
                     break
-        if not hex_code_found:
-            UNKNOWN_CODES.append(file_content.hex()[:12])
-
-        if path_to_use == EXTENDED_PATH and not hex_code_found and FILE_LIST != NEW_GZ_FILES:
-            recover_gz_files(path_to_use, file_content, file_path)
-        cleanup_js_files(path_to_use, file_content, full_path)
+            if not head:
+                continue # Not valid GZ data after all
+            METRICS.add('extract')
+            ext = classify(head)
+            if ext is None:
+                continue # Expanded to something we don't know, no expanded copy is saved
+            if not wants_type(SELECT, ext):
+                METRICS.add('filtered')
+                continue
+            payload = payload._replace(content=None, chunks=chain((head,), chunks))
+        yield payload, ext
+
+def save_stage(items):
+    """Last stage: write everything we identified, and keep track of what we didn't.
+    Unidentified fragments are kept in the DATA folder to be looked at manually.
+
+    :param items: generator of (Payload, extension or None)
+    :returns:     generator of Result, one per payload
+    """
+    for payload, ext in items:
+        location = None
+        if ext is not None:
+            METRICS.types[ext.replace(".", "")] += 1
+            location = SINK.location(ext.replace(".", ""), f'{payload.name}{ext}')
+            OUTPUTS.setdefault(payload.name, []).append(location)
+            if payload.chunks is not None:
+                save_file(location, payload.chunks)
+            elif payload.content is not None: # Read ahead, so write it from memory
+                save_file(location, read_payload_chunks(payload))
+            else: # Still only a range of a cache file, so copy it without reading it
+                copy_file(payload.path, location, offset=payload.offset, size=payload.size)
+            yield Result(payload.path, ext.replace(".", ""), payload.offset, payload.size, location)
+            continue
+        METRICS.types['unknown'] += 1
+        UNKNOWN.add(read_payload(payload, max(PREFIX_LENGTHS)), payload.size, payload.name)
+        if payload.kind == 'fragment':
+            content = read_payload(payload)
+            if content[-3:] != b'.js':
+                # Fragments ending in .js are junk data combined with a URL to an online JS file
+                location = SINK.location('DATA', payload.name)
+                OUTPUTS.setdefault(payload.name, []).append(location)
+                save_split_file(location, content)
+        yield Result(payload.path, None, payload.offset, payload.size, location)
+
+def take_counts():
+    """Return the metrics, unknown signatures and outputs gathered in this process, and reset them.
+
+    :returns: tuple of (metrics from Metrics.take, unknown signatures from SignatureCounter.take,
+              outputs, saved files, outputs that couldn't be saved)
+    """
+    counts = (METRICS.take(), UNKNOWN.take(), dict(OUTPUTS), CONTENTS.take_added(), dict(FAILED))
+    OUTPUTS.clear()
+    FAILED.clear()
+    return counts
+
+def open_manifest(save_path, output):
+    """Open the manifest in a Saved folder (creating it if needed). Everything the manifest has
+    is in the sink it was saved to, so a Saved folder has to keep the same output.
+
+    :param save_path: full directory path (...path\\Saved)
+    :param output:    sink name from SINKS
+    :returns:         Manifest
+    :raises ValueError: if the Saved folder was saved to another output
+    """
+    manifest = Manifest(join(save_path, MANIFEST_NAME))
+    saved_to = manifest.setting('output')
+    if saved_to is None:
+        manifest.set_setting('output', output)
+    elif saved_to != output:
+        manifest.close()
+        raise ValueError(f'{save_path} was saved with the {saved_to} output, '
+                         f'use that or save somewhere else')
+    return manifest
+
+def open_output(output, save_path, contents=()):
+    """Open the sink outputs are saved to, and the content index to dedupe against it.
+
+    :param output:    sink name from SINKS
+    :param save_path: full directory path (...path\\Saved)
+    :param contents:  (location, size, digest) rows of everything saved before
+    """
+    global SINK, CONTENTS
+    SINK = open_sink(output, save_path, WRITE_BEHIND, WRITE_BEHIND_MEMORY)
+    CONTENTS = ContentIndex(contents, SINK.exists, SINK.digest)
 
-    if path_to_use == EXTENDED_PATH:
-        move_data_files()
+def forget_output(location):
+    """Forget an output that couldn't be saved, and mark the source it came from as failed,
+    so the manifest doesn't record the source and the next run tries it again.
 
+    :param location: sink location of the output
+    """
+    CONTENTS.discard(location)
+    for source, locations in OUTPUTS.items():
+        if location in locations:
+            locations.remove(location)
+            FAILED[location] = source
+            return
 
-if isdir(f'{FOLDER_PATH}\\Saved'):
-    raise Exception('Please delete your Saved folder then try running again!')
+def report_failed(failed):
+    """Report outputs the sink failed to write in the background, and forget them.
 
-FILE_LIST = get_file_list(FOLDER_PATH)
-main(FOLDER_PATH) # Run for the untouched cache files
+    :param failed: (location, error) list from the sink's flush or close
+    """
+    for location, error in failed:
+        forget_output(location)
+        if isinstance(error, PermissionError):
+            METRICS.event('error',
+                          'PermissionError: File save failed, file is likely locked / in use.',
+                          location=location)
 
-FILE_LIST = get_file_list(EXTENDED_PATH)
-main(EXTENDED_PATH) # Run for the split up data files
+def apply_options(options):
+    """Set the module settings an Options covers.
 
-FILE_LIST = NEW_GZ_FILES
-main(EXTENDED_PATH) # Run for any recovered data with GZ signatures from the split up data files
+    :param options: Options
+    """
+    global READ_AHEAD, READ_AHEAD_MEMORY, WRITE_BEHIND, WRITE_BEHIND_MEMORY, OFFICE_STREAMS
+    global SPLIT_BYTE_COUNT, SELECT, SHARD
+    READ_AHEAD, WRITE_BEHIND = options.read_ahead, options.write_behind
+    READ_AHEAD_MEMORY = WRITE_BEHIND_MEMORY = options.io_memory
+    OFFICE_STREAMS = options.office_streams
+    SPLIT_BYTE_COUNT = options.byte_count
+    SELECT = options.select
+    SHARD = options.shard
+
+def start_worker(contents, save_path, options, logging):
+    """Process pool initializer - start from zero, with its own handle on the sink and
+    the files saved before the pool started.
+
+    :param contents:  (location, size, digest) rows from the main process's content index
+    :param save_path: full directory path (...path\\Saved)
+    :param options:   Options from the main process (without its log)
+    :param logging:   keep events to hand back to the main process, to print or log
+    """
+    global METRICS
+    apply_options(options)
+    take_counts()
+    # Events are printed by the main process once merged, as some turn out to be duplicates there
+    METRICS = Metrics(False, log=[] if logging else None)
+    open_output(options.output, save_path, contents)
+
+def merge_counts(counts):
+    """Add metrics and unknown signatures from take_counts (eg. from a worker) to this process.
+    Files the worker saved are checked for duplicates saved by other workers - the worker counted
+    those as new files, so they are taken off its counts and events, as in a serial run.
+
+    :param counts: tuple from take_counts
+    """
+    metrics, unknown, outputs, added, failed = counts
+    linked = set()
+    for location, size, digest in added:
+        if location in failed:
+            continue
+        if dedupe_output(location, size, digest or partial(SINK.digest, location)):
+            linked.add(location)
+            metrics[0]['new_file'] -= 1
+            metrics[0]['bytes_out'] -= size
+    events = [record for record in metrics[3]
+              if record['event'] != 'new_file' or record.get('location') not in linked]
+    METRICS.merge((*metrics[:3], events))
+    UNKNOWN.merge(unknown)
+    for source, source_outputs in outputs.items():
+        OUTPUTS.setdefault(source, []).extend(source_outputs)
+    FAILED.update(failed)
+
+def extract_stages(payloads):
+    """Run payloads through every stage after splitting, timing each one.
+
+    :param payloads: iterable of Payload from the split stage
+    :returns:        generator of Result
+    """
+    payloads = METRICS.timed('read_ahead', read_ahead_stage(payloads))
+    items = METRICS.timed('classify', classify_stage(payloads))
+    items = METRICS.timed('decompress', decompress_stage(items))
+    return METRICS.timed('save', save_stage(items))
 
-remove_empty_directories(f'{FOLDER_PATH}\\Saved')
-remove_empty_directories(f'{EXTENDED_PATH}\\Saved')
+def process_payloads(payloads):
+    """Run a batch of payloads through every stage after splitting. This is the process pool task.
 
-try:
-    if len(listdir(f'{EXTENDED_PATH}\\Saved')) == 0:
-        rmdir(f'{EXTENDED_PATH}\\Saved')
-except FileNotFoundError:
-    pass
+    :param payloads: list of Payload from the split stage
+    :returns:        tuple of (Result list, counts from take_counts) for just this batch
+    """
+    results = list(extract_stages(payloads))
+    # Workers are never closed, so the batch has to be written before it is merged
+    report_failed(SINK.flush())
+    return results, take_counts()
+
+def batches(payloads, size):
+    """Group payloads into lists of up to size, to hand to workers."""
+    payloads = iter(payloads)
+    while batch := list(islice(payloads, size)):
+        yield batch
+
+def run_pipeline(folder, save_path, options):
+    """Run every stage over a cache folder, one payload at a time.
+    Anything the manifest in the Saved folder says is unchanged since the last run is skipped.
+    With more than one worker, the cache is still listed and split here, but every payload
+    after that is handed to a process pool. Batches are made on this thread (the manifest stage
+    removes outputs from the sink, which only this thread can touch) and results are merged back
+    in order, so the outputs and counts are the same as a serial run.
+    The manifest is only updated once every result has been taken, so a run that is stopped
+    early is picked up from the start next time (anything already saved is skipped).
+
+    :param folder:    full directory path of the cache
+    :param save_path: full directory path to save to (...path\\Saved)
+    :param options:   Options - workers is the number of worker processes, and tar and zip
+                      outputs can only have one
+    :returns:         generator of Result
+    """
+    if not isdir(save_path):
+        mkdir(save_path)
+    manifest = open_manifest(save_path, options.output)
+    open_output(options.output, save_path, manifest.contents())
+    try:
+        payloads = METRICS.timed('source', cache_source(folder))
+        payloads = METRICS.timed('manifest',
+                                 manifest_stage(payloads, manifest, ('file', 'entry', 'data')))
+        payloads = METRICS.timed('split', split_stage(payloads))
+        payloads = METRICS.timed('manifest', manifest_stage(payloads, manifest, ('fragment',)))
+        if options.workers <= 1:
+            yield from extract_stages(payloads)
+        else:
+            report_failed(SINK.flush())
+            logging = options.verbose or METRICS.log is not None
+            initargs = (CONTENTS.rows(), save_path, options._replace(log=None), logging)
+            with Pool(options.workers, initializer=start_worker, initargs=initargs) as pool:
+                pending = deque()
+                for batch in batches(payloads, WORKER_CHUNK_SIZE):
+                    # Anything the manifest removed has to be gone before a worker looks for it
+                    report_failed(SINK.flush())
+                    pending.append(pool.apply_async(process_payloads, (batch,)))
+                    while pending and (len(pending) > options.workers * WORKER_BACKLOG
+                                       or pending[0].ready()):
+                        results, counts = pending.popleft().get()
+                        merge_counts(counts)
+                        yield from results
+                while pending:
+                    results, counts = pending.popleft().get()
+                    merge_counts(counts)
+                    yield from results
+        report_failed(SINK.flush())
+        update_manifest(manifest)
+        manifest.record_contents(CONTENTS.rows())
+    finally:
+        SINK.close()
+        manifest.close()
+
+def check_save_path(save_path):
+    """Make sure a Saved folder is either new or one we made, so nothing else in it is touched.
+
+    :param save_path: full directory path to save to
+    :raises ValueError: if the folder is there but has no manifest
+    """
+    if isdir(save_path) and not isfile(join(save_path, MANIFEST_NAME)):
+        raise ValueError('Please delete your Saved folder then try running again!')
+
+def extract(source, options=None):
+    """Extract everything from a cache folder (or just what options.select picks out), yielding
+    a Result for each payload as soon as it has been dealt with. Nothing is done until the first
+    Result is asked for, and a caller can stop whenever it likes - the sink and manifest are
+    closed either way.
+    Counters and stage times for the run are left in METRICS.
+
+    :param source:  full directory path of the cache
+    :param options: Options, or None for the defaults
+    :returns:       generator of Result
+    """
+    global METRICS
+    options = options or Options()
+    save_path = options.save_path or join(source, 'Saved')
+    if options.workers > 1 and options.output in ('tar', 'zip'):
+        raise ValueError('workers can only be used with the dir or sqlite output')
+    check_save_path(save_path)
+
+    apply_options(options)
+    METRICS = Metrics(options.verbose, options.progress, options.log)
+    take_counts() # Anything left over from a run that was stopped early
+    MANIFEST_UPDATES.clear()
+    try:
+        yield from run_pipeline(source, save_path, options)
+        output_unknown_headers(save_path)
+    finally:
+        METRICS.close()
 
-output_unknown_headers()
 
-print(f'\nRead {READ_COUNT} -- Wrote {WRITE_COUNT}\
--- Extracted {EXTRACT_COUNT} -- Skipped {SKIP_COUNT}')
+if __name__ == '__main__':
+    runpy.run_module('cli', run_name='__main__') # The command line is in cli.py
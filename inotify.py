@@ -0,0 +1,85 @@
+"""
+Watch a folder for new and changed files with Linux inotify, through ctypes so nothing extra
+has to be installed.
+
+Only files directly in the folder are watched (the cache folder is flat). If the kernel's event
+queue overflows, events are lost - read returns None in place of a name when that happens,
+so the caller knows to look at everything again.
+
+Author - James M. (yakasov)
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct('iIII') # Watch descriptor, mask, cookie, name length - then the name
+READ_SIZE = 64 * 1024
+
+class Inotify:
+    """An inotify watch on one folder."""
+
+    def __init__(self, folder):
+        """Start watching.
+
+        :param folder: full directory path to watch
+        :raises OSError: if inotify isn't available (eg. not on Linux), or the folder can't be
+                         watched
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, TypeError, AttributeError) as e:
+            raise OSError('Watching needs Linux inotify') from e
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if add_watch(self.fd, os.fsencode(folder), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f'Could not watch {folder}')
+
+    def read(self, timeout=None):
+        """Wait for events.
+
+        :param timeout: most seconds to wait, or None to wait for as long as it takes
+        :returns:       list of changed file names, with None if events were lost - empty if
+                        nothing happened before the timeout
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        names = []
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            _, mask, _, length = EVENT.unpack_from(data, pos)
+            name = data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\x00')
+            pos += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                names.append(None)
+            elif name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
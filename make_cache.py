@@ -0,0 +1,443 @@
+"""
+Build a fake Teams cache to test and benchmark the extractor with, so no real one has to be shared.
+
+The cache is laid out like a cache that has lost its index - loose f_XXXXXX files, and data_0 to
+data_3 block files with smaller files packed into null padded blocks - so every file has to be
+found by splitting and sniffing. It has a mix of what turns up in real caches:
+
+    - PNG, JPEG, JSON, JS, HTML and PDF files, some of them GZ compressed
+    - Office compound files (.DOC, .XLS, .PPT, .MSG), some with only their directory to say which
+    - GZ and PNG files with junk data in front of them, that have to be carved out
+    - PNG files with long runs of nulls in them, that splitting alone would cut in two
+    - files with signatures the extractor doesn't know
+    - the same content cached more than once
+
+With --index, it is laid out like a blockfile cache that still has its index, as real Teams
+caches are - an index hash table of entries in data_1, each with its URL as the key, a headers
+stream and a body in a data_N block file or an f_XXXXXX file of its own (see blockfile.py).
+With --simple, it is laid out like a newer simple format cache instead - every entry in a
+<hash>_0 file of its own, with its URL and HTTP headers around the body (see simplecache.py).
+Both only hold whole files, so nothing is carved or split - those kinds are left out.
+
+Everything the extractor should recover is written to a ground truth JSON file next to the cache,
+and for entries, the name it should be saved under (from its URL).
+
+Usage: python make_cache.py <folder> [--files N] [--seed N] [--max-size BYTES] [--index | --simple]
+
+Author - James M. (yakasov)
+"""
+
+from os.path import isdir, join
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import struct
+import zlib
+
+from blockfile import key_to_name
+from dedupe import new_digest
+
+BLOCK_SIZES = {'data_1': 256, 'data_2': 1024, 'data_3': 4096} # Block size of each block file
+MAX_BLOCKS = 4 # Entries bigger than 4 blocks of data_3 are kept in their own f_XXXXXX file
+MIN_PADDING = 64 # Nulls between files in a block file, must be more than BYTE_COUNT
+RANKINGS_SIZE = 20 # data_0 only holds small records, too small to be kept as fragments
+DUPLICATE_CHANCE = 0.1 # Chance of caching content that has already been cached
+BLOCK_FILE_CHANCE = 0.6 # Chance of a small file going into a block file instead of its own file
+CFB_SECTOR_SIZE = 512
+MINI_STREAM_CUTOFF = 4096 # Smaller streams go in the mini stream, which isn't made here
+BLOCK_ONLY_SIZE = 4096 # Kinds that are only worth testing in block files are kept this small
+NULL_RUN_SIZE = 100 # Nulls in the middle of a png_nulls file, more than BYTE_COUNT
+
+# Kind: (chance, extension it should be saved as, how it is wrapped in the cache)
+KINDS = {
+    'png': (20, 'PNG', None),
+    'jpeg': (15, 'JPEG', None),
+    'png_gz': (5, 'PNG', 'gz'),
+    'jpeg_gz': (5, 'JPEG', 'gz'),
+    'json_gz': (15, 'JSON', 'gz'),
+    'js_gz': (10, 'JS', 'gz'),
+    'html_gz': (3, 'HTML', 'gz'),
+    'json': (5, 'JSON', None),
+    'pdf': (3, 'PDF', None),
+    'doc': (2, 'DOC', None),
+    'xls': (2, 'XLS', None),
+    'ppt': (2, 'PPT', None),
+    'office': (2, 'PPT', None), # FAT in the first sector, so only the directory says what it is
+    'msg': (1, 'MSG', None),
+    'junk_gz': (5, 'JSON', 'junk+gz'),
+    'junk_png': (3, 'PNG', 'junk'),
+    'png_nulls': (2, 'PNG', None),
+    'unknown': (6, None, None),
+}
+OFFICE_STREAMS = { # Kind: (stream name, signature its data starts with), main stream first
+    'doc': [('WordDocument', b'\xec\xa5\xc1\x00'), ('1Table', b'')],
+    'xls': [('Workbook', b'\x09\x08\x10\x00\x00\x06\x05\x00')],
+    'ppt': [('PowerPoint Document', b'\xa0\x46\x1d\xf0'), ('Current User', b'')],
+    'office': [('PowerPoint Document', b'\xa0\x46\x1d\xf0'), ('Current User', b'')],
+    'msg': [('__substg1.0_1000001F', b''), ('__substg1.0_0037001F', b''),
+            ('__properties_version1.0', b'')],
+}
+CFB_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+CFB_HEADER = struct.Struct('<8s16xHHHHH6xIIIIIIIII') # Followed by the first 109 DIFAT entries
+CFB_ENTRY = struct.Struct('<64sHBBIII16xI16xIQ') # Directory entry, 128 bytes
+END_OF_CHAIN, FAT_SECTOR, FREE_SECTOR, NO_STREAM = 0xFFFFFFFE, 0xFFFFFFFD, 0xFFFFFFFF, 0xFFFFFFFF
+UNKNOWN_SIGNATURE = b'\xde\xad\xbe\xef'
+BLOCK_ONLY = {'junk_gz', 'junk_png', 'png_nulls'} # Always put in block files, that's what they test
+SIMPLE_INITIAL_MAGIC = 0xFCFB6D1BA7725C30
+SIMPLE_FINAL_MAGIC = 0xF4FA6F45970D41D8
+SIMPLE_INDEX_MAGIC = 0x656E74657220796F # A simple cache's index file only holds this and a version
+SIMPLE_VERSION = 5
+SIMPLE_HAS_CRC32, SIMPLE_HAS_KEY_SHA256 = 1, 2
+SIMPLE_RECORD = struct.Struct('<QIII4x') # Header and EOF records are both this shape
+INDEX_MAGIC, BLOCK_MAGIC = 0xC103CAC3, 0xC104CAC3
+BLOCKFILE_VERSION = 0x20000
+INDEX_HEADER_SIZE = 368 # IndexHeader and LruData, the hash table follows
+INDEX_TABLE_LEN = 0x1000 # Buckets in the index hash table, a power of two
+BLOCK_HEADER_SIZE = 8192 # Block file header and allocation bitmap, blocks follow
+BLOCK_FILE_TYPES = {'data_1': 2, 'data_2': 3, 'data_3': 4} # Cache address file type of each
+ADDR_INITIALIZED = 0x80000000
+ENTRY_STORE = struct.Struct('<IIIiiiQiI4i4II16xI') # The key follows, up to 4 blocks of data_1
+RANKINGS_BLOCK_SIZE = 36 # Block size of data_0 in a cache with an index
+URL_PREFIX = 'https://statics.teams.cdn.office.net'
+WORDS = ['teams', 'message', 'channel', 'user', 'avatar', 'emoji', 'thread', 'meeting',
+         'chat', 'presence', 'tenant', 'calendar', 'file', 'reply', 'reaction', 'status']
+
+def random_bytes(rng, size):
+    """Random bytes with no nulls, so they can't be mistaken for block padding."""
+    return rng.randbytes(size).replace(b'\x00', b'\x01')
+
+def random_text(rng, size):
+    """Random words, to stand in for JSON/JS/HTML text (compresses like the real thing)."""
+    words = []
+    length = 0
+    while length < size:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+    return ' '.join(words)
+
+def png_chunk(chunk_type, data):
+    """A PNG chunk - length, type, data and CRC."""
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+def make_png(data):
+    """A PNG that is valid as far as its chunks go, with data as its image data."""
+    header = struct.pack('>IIBBBBB', 64, 64, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) + png_chunk(b'IDAT', data)
+            + png_chunk(b'IEND', b''))
+
+def make_jpeg(data):
+    """A JPEG that is valid as far as its segments go, with data as its scan (FF bytes stuffed)."""
+    app0 = b'\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    scan = b'\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00'
+    return b'\xff\xd8' + app0 + scan + data.replace(b'\xff', b'\xff\x00') + b'\xff\xd9'
+
+def make_cfb(streams, fat_first=False):
+    """A compound file (version 3) holding streams, all at the top of its directory.
+
+    :param streams:   list of (name, data), every stream at least MINI_STREAM_CUTOFF long
+    :param fat_first: put the FAT in the first sector, instead of the first stream's data
+    :returns:         file content as bytes
+    """
+    def sectors_of(size):
+        return -(-size // CFB_SECTOR_SIZE)
+
+    stream_sectors = [sectors_of(len(data)) for _, data in streams]
+    directory_sectors = sectors_of((len(streams) + 1) * 128)
+    fat_sectors = 1
+    while fat_sectors * CFB_SECTOR_SIZE // 4 < sum(stream_sectors, directory_sectors + fat_sectors):
+        fat_sectors += 1
+    layout = [('fat', fat_sectors)] if fat_first else []
+    layout += list(enumerate(stream_sectors))
+    layout += [] if fat_first else [('fat', fat_sectors)]
+    layout.append(('directory', directory_sectors))
+
+    starts, fat, position = {}, [], 0
+    for part, count in layout:
+        starts[part] = position
+        if part == 'fat':
+            fat += [FAT_SECTOR] * count
+        else:
+            fat += list(range(position + 1, position + count)) + [END_OF_CHAIN]
+        position += count
+    fat += [FREE_SECTOR] * (fat_sectors * CFB_SECTOR_SIZE // 4 - len(fat))
+
+    entries = [CFB_ENTRY.pack('Root Entry'.encode('utf-16-le'), 22, 5, 1,
+                              NO_STREAM, NO_STREAM, 1, 0, END_OF_CHAIN, 0)]
+    for i, (name, data) in enumerate(streams):
+        encoded = name.encode('utf-16-le')
+        right = i + 2 if i + 1 < len(streams) else NO_STREAM # A chain of right siblings
+        entries.append(CFB_ENTRY.pack(encoded, len(encoded) + 2, 2, 1,
+                                      NO_STREAM, right, NO_STREAM, 0, starts[i], len(data)))
+    while len(entries) * CFB_ENTRY.size < directory_sectors * CFB_SECTOR_SIZE:
+        entries.append(CFB_ENTRY.pack(b'', 0, 0, 0, NO_STREAM, NO_STREAM, NO_STREAM, 0, 0, 0))
+
+    difat = [starts['fat'] + i for i in range(fat_sectors)]
+    header = CFB_HEADER.pack(CFB_SIGNATURE, 0x3E, 3, 0xFFFE, 9, 6, 0, fat_sectors,
+                             starts['directory'], 0, MINI_STREAM_CUTOFF, END_OF_CHAIN, 0,
+                             END_OF_CHAIN, 0)
+    header += struct.pack('<109I', *(difat + [FREE_SECTOR] * (109 - len(difat))))
+    parts = {'fat': struct.pack(f'<{len(fat)}I', *fat), 'directory': b''.join(entries)}
+    parts.update((i, data) for i, (_, data) in enumerate(streams))
+    body = b''.join(parts[part].ljust(count * CFB_SECTOR_SIZE, b'\x00') for part, count in layout)
+    return header + body
+
+def make_content(rng, kind, size):
+    """Make the (uncompressed) content of a file.
+
+    :param rng:  random.Random to use
+    :param kind: key from KINDS
+    :param size: rough size in bytes
+    :returns:    file content as bytes
+    """
+    kind = kind.replace('_gz', '').replace('junk_', '')
+    if kind == 'png':
+        return make_png(random_bytes(rng, size))
+    if kind == 'png_nulls':
+        half = random_bytes(rng, max(size // 2, 16))
+        return make_png(half + b'\x00' * NULL_RUN_SIZE + half)
+    if kind == 'jpeg':
+        return make_jpeg(random_bytes(rng, size))
+    if kind in ('json', 'junk'):
+        return json.dumps({'id': rng.randrange(10 ** 9), 'text': random_text(rng, size)}).encode()
+    if kind == 'js':
+        return f'/* bundle */ var {rng.choice(WORDS)} = "{random_text(rng, size)}";'.encode()
+    if kind == 'html':
+        return f'<!DOCTYPE html><html><body>{random_text(rng, size)}</body></html>'.encode()
+    if kind == 'pdf':
+        return b'%PDF-1.4\n' + random_bytes(rng, size) + b'\n%%EOF'
+    if kind in OFFICE_STREAMS:
+        streams = [(name, signature + random_bytes(rng, max(size, MINI_STREAM_CUTOFF)))
+                   for name, signature in OFFICE_STREAMS[kind]]
+        return make_cfb(streams, fat_first=kind == 'office')
+    return UNKNOWN_SIGNATURE + random_bytes(rng, size)
+
+def wrap(rng, content, wrapping):
+    """Wrap content the way it is stored in the cache."""
+    if wrapping is None:
+        return content
+    data = content if wrapping == 'junk' else gzip.compress(content, mtime=0)
+    if wrapping.startswith('junk'): # Junk never contains a signature, as it is only letters
+        data = random_text(rng, rng.randrange(40, 200)).encode() + data
+    return data
+
+def digest_of(content):
+    """Hash content the same way the extractor does."""
+    digest = new_digest()
+    digest.update(content)
+    return digest.hexdigest()
+
+def make_simple_entry(key, body):
+    """Lay an entry out like a simple cache <hash>_0 file - header, key, body and its EOF record,
+    then the HTTP headers, the key's SHA-256 and their EOF record.
+
+    :param key:  entry key as a string
+    :param body: response body as bytes
+    :returns:    tuple of (file name, file contents)
+    """
+    key = key.encode()
+    headers = b'HTTP/1.1 200\x00content-length: %d\x00\x00' % len(body)
+    name = f'{int.from_bytes(hashlib.sha1(key).digest()[:8], "little"):016x}_0'
+    return name, b''.join([
+        SIMPLE_RECORD.pack(SIMPLE_INITIAL_MAGIC, SIMPLE_VERSION, len(key), zlib.crc32(key)), key,
+        body, SIMPLE_RECORD.pack(SIMPLE_FINAL_MAGIC, SIMPLE_HAS_CRC32, zlib.crc32(body), len(body)),
+        headers, hashlib.sha256(key).digest(),
+        SIMPLE_RECORD.pack(SIMPLE_FINAL_MAGIC, SIMPLE_HAS_CRC32 | SIMPLE_HAS_KEY_SHA256,
+                           zlib.crc32(headers), len(headers))])
+
+class BlockFiles:
+    """data_1 to data_3 of a cache with an index, giving out cache addresses as blocks are used."""
+
+    def __init__(self):
+        self.blocks = {name: bytearray() for name in BLOCK_SIZES}
+
+    def store(self, name, data):
+        """Put data in the next free blocks of a block file.
+
+        :param name: block file name from BLOCK_SIZES
+        :param data: bytes, at most MAX_BLOCKS blocks long
+        :returns:    cache address of the data
+        """
+        block_size = BLOCK_SIZES[name]
+        count = max(-(-len(data) // block_size), 1)
+        start = len(self.blocks[name]) // block_size
+        self.blocks[name] += data.ljust(count * block_size, b'\x00')
+        return (ADDR_INITIALIZED | BLOCK_FILE_TYPES[name] << 28 | (count - 1) << 24
+                | int(name[-1]) << 16 | start)
+
+    def write(self, folder):
+        """Write every block file, with its header, to folder."""
+        for name, blocks in self.blocks.items():
+            with open(join(folder, name), 'wb') as f:
+                f.write(block_file_header(int(name[-1]), BLOCK_SIZES[name]))
+                f.write(blocks)
+
+def block_file_header(selector, block_size):
+    """The header of data_<selector>, padded out to where its blocks start."""
+    header = struct.pack('<IIhhi', BLOCK_MAGIC, BLOCKFILE_VERSION, selector, 0, block_size)
+    return header.ljust(BLOCK_HEADER_SIZE, b'\x00')
+
+def make_entry_store(key, key_hash, next_addr, streams):
+    """Lay out an index entry - the EntryStore fields, then its key inline.
+
+    :param key:       entry key as a string
+    :param key_hash:  hash of the key, which picks the entry's index bucket
+    :param next_addr: cache address of the next entry in the same bucket, or 0
+    :param streams:   (cache address, size) of the headers stream and the body
+    :returns:         EntryStore as bytes
+    """
+    key = key.encode()
+    streams = list(streams) + [(0, 0)] * (4 - len(streams))
+    fields = ENTRY_STORE.pack(key_hash, next_addr, 0, 0, 0, 0, 0, len(key), 0,
+                              *(size for _, size in streams), *(addr for addr, _ in streams), 0, 0)
+    return fields + key + b'\x00'
+
+def write_index(folder, entries, blocks):
+    """Write the index of a cache - every entry is stored in data_1 and chained into its bucket.
+
+    :param folder:  directory the cache is in
+    :param entries: (key, key hash, streams) of every entry, see make_entry_store
+    :param blocks:  BlockFiles to store the entries in
+    """
+    table = [0] * INDEX_TABLE_LEN
+    for key, key_hash, streams in entries:
+        bucket = key_hash & (INDEX_TABLE_LEN - 1)
+        entry = make_entry_store(key, key_hash, table[bucket], streams)
+        table[bucket] = blocks.store('data_1', entry)
+    header = struct.pack('<IIiiiiIiii', INDEX_MAGIC, BLOCKFILE_VERSION, len(entries), 0, 0, 0, 0,
+                         INDEX_TABLE_LEN, 0, 0)
+    with open(join(folder, 'index'), 'wb') as f:
+        f.write(header.ljust(INDEX_HEADER_SIZE, b'\x00'))
+        f.write(struct.pack(f'<{INDEX_TABLE_LEN}I', *table))
+
+def pad_to_blocks(data, block_size):
+    """Pad data with nulls up to a whole number of blocks, with at least MIN_PADDING nulls."""
+    padded = -(-(len(data) + MIN_PADDING) // block_size) * block_size
+    return data + b'\x00' * (padded - len(data))
+
+def make_cache(folder, files=1000, seed=0, max_size=256 * 1024, simple=False, index=False):
+    """Write a fake cache to folder.
+
+    :param folder:   directory to write the cache to, made if it isn't there
+    :param files:    number of files to put in the cache
+    :param seed:     random seed - the same seed always gives the same cache
+    :param max_size: biggest file to make, in bytes (sizes are spread evenly on a log scale)
+    :param simple:   lay it out like a simple format cache, with no block files
+    :param index:    lay it out like a blockfile cache with its index, every file an entry
+    :returns:        ground truth as a list of dictionaries, one per file that should be recovered
+    :raises ValueError: if both simple and index are asked for
+    """
+    if simple and index:
+        raise ValueError('A cache can only be simple or have an index, not both')
+    rng = random.Random(seed)
+    if not isdir(folder):
+        os.makedirs(folder)
+    kinds = [kind for kind in KINDS if not ((simple or index) and kind in BLOCK_ONLY)]
+    weights = [KINDS[kind][0] for kind in kinds]
+    block_files = {name: [] for name in BLOCK_SIZES}
+    blocks = BlockFiles() # Used instead of block_files with an index
+    entries = [] # (key, key hash, streams) of every index entry
+    made = [] # (kind, content) of everything made so far, for duplicates
+    truth = []
+    external = 0
+
+    for _ in range(files):
+        if made and rng.random() < DUPLICATE_CHANCE:
+            kind, content = rng.choice(made)
+        else:
+            kind = rng.choices(kinds, weights)[0]
+            size = int(min(max_size, 100 * (max_size / 100) ** rng.random()))
+            if kind in BLOCK_ONLY:
+                size = min(size, BLOCK_ONLY_SIZE)
+            content = make_content(rng, kind, size)
+            made.append((kind, content))
+        _, ext, wrapping = KINDS[kind]
+        data = wrap(rng, content, wrapping)
+
+        block_file = next((name for name, block_size in BLOCK_SIZES.items()
+                           if len(data) + MIN_PADDING <= block_size * MAX_BLOCKS), None)
+        name = None
+        if index:
+            key = (f'1/0/_dk_https://teams.microsoft.com '
+                   f'{URL_PREFIX}/{rng.choice(WORDS)}/{len(entries) + 1}')
+            key_hash = zlib.crc32(key.encode())
+            headers = b'HTTP/1.1 200\x00content-length: %d\x00\x00' % len(data)
+            if block_file is None:
+                external += 1
+                source, body = f'f_{external:06x}', ADDR_INITIALIZED | external
+                with open(join(folder, source), 'wb') as f:
+                    f.write(data)
+            else:
+                source, body = block_file, blocks.store(block_file, data)
+            entries.append((key, key_hash, [(blocks.store('data_1', headers), len(headers)),
+                                            (body, len(data))]))
+            name = key_to_name(key, key_hash)
+        elif simple:
+            external += 1
+            source, data = make_simple_entry(f'1/0/_dk_https://teams.microsoft.com '
+                                             f'{URL_PREFIX}/{rng.choice(WORDS)}/{external}', data)
+            with open(join(folder, source), 'wb') as f:
+                f.write(data)
+        elif block_file is not None and (kind in BLOCK_ONLY or rng.random() < BLOCK_FILE_CHANCE):
+            block_files[block_file].append(pad_to_blocks(data, BLOCK_SIZES[block_file]))
+            source = block_file
+        else:
+            external += 1
+            source = f'f_{external:06x}'
+            with open(join(folder, source), 'wb') as f:
+                f.write(data)
+        if ext is not None:
+            truth.append({'source': source, 'ext': ext, 'size': len(content),
+                          'digest': digest_of(content), 'wrapping': wrapping})
+            if name is not None:
+                truth[-1]['name'] = f'{name}.{ext}'
+
+    if index:
+        write_index(folder, entries, blocks)
+        blocks.write(folder)
+        with open(join(folder, 'data_0'), 'wb') as f:
+            f.write(block_file_header(0, RANKINGS_BLOCK_SIZE)) # No rankings, nothing reads them
+        return truth
+    if simple:
+        with open(join(folder, 'index'), 'wb') as f:
+            f.write(struct.pack('<QII', SIMPLE_INDEX_MAGIC, SIMPLE_VERSION, 0))
+        return truth
+    with open(join(folder, 'data_0'), 'wb') as f:
+        f.write(b'\x00' * 8192) # Header, then small rankings records nothing should be kept from
+        for _ in range(files):
+            f.write(pad_to_blocks(random_bytes(rng, RANKINGS_SIZE), 36))
+    for name, blocks in block_files.items():
+        with open(join(folder, name), 'wb') as f:
+            f.write(b'\x00' * 8192) # Block file header and allocation bitmap, left empty
+            f.writelines(blocks)
+    return truth
+
+def truth_path(folder):
+    """Where the ground truth for a cache is kept - next to it, so it isn't taken for cache data."""
+    return f'{os.path.normpath(folder)}_truth.json'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build a fake Teams cache to test the extractor with.')
+    parser.add_argument('folder', help='directory to write the cache to')
+    parser.add_argument('--files', type=int, default=1000, help='number of files (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--max-size', type=int, default=256 * 1024,
+                        help='biggest file in bytes (default: 262144)')
+    formats = parser.add_mutually_exclusive_group()
+    formats.add_argument('--index', action='store_true',
+                         help='lay it out like a cache with its blockfile index, as Teams has')
+    formats.add_argument('--simple', action='store_true',
+                         help='lay it out like a simple format cache, every entry in its own file')
+    args = parser.parse_args()
+
+    cache_truth = make_cache(args.folder, args.files, args.seed, args.max_size, args.simple,
+                             args.index)
+    with open(truth_path(args.folder), 'w', encoding='utf-8') as truth_file:
+        json.dump(cache_truth, truth_file, indent=1)
+    print(f'Wrote {args.files} files to {args.folder}, {len(cache_truth)} of them should be '
+          f'recovered')
@@ -0,0 +1,109 @@
+"""
+Keep track of what has already been extracted from a cache, so a re-run only has to look at
+cache files, index entries and data file fragments that are new or have changed since.
+
+The manifest is a SQLite database kept in the Saved folder. There is one row per source
+(named the same way as its outputs, eg. f_000001, data_1_3 or an entry's URL name) with the
+size, modified time and content hash it had when it was extracted, and the files it produced.
+Every saved file's size and content hash (if it was ever needed) is kept too, for dedupe.py,
+and so are the settings the Saved folder was made with (eg. the output it was saved to).
+
+Author - James M. (yakasov)
+"""
+
+from collections import namedtuple
+import json
+import sqlite3
+
+MANIFEST_NAME = 'manifest.sqlite'
+
+Source = namedtuple('Source', ['size', 'mtime', 'digest', 'outputs'])
+Source.__doc__ = 'What a source looked like when it was extracted, and what it produced.'
+
+class Manifest:
+    """SQLite backed record of every extracted source. Changes are only saved on close or commit."""
+
+    def __init__(self, path):
+        """Open (or create) the manifest.
+
+        :param path: full file path of the manifest database
+        """
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS sources ('
+            'source TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT, outputs TEXT)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS contents ('
+            'path TEXT PRIMARY KEY, size INTEGER, digest TEXT)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+
+    def get(self, source):
+        """Look up a source from a previous run.
+
+        :param source: source name
+        :returns:      Source, or None if it hasn't been seen before
+        """
+        row = self.connection.execute(
+            'SELECT size, mtime, digest, outputs FROM sources WHERE source = ?',
+            (source,)).fetchone()
+        if row is None:
+            return None
+        return Source(row[0], row[1], row[2], json.loads(row[3]))
+
+    def record(self, source, size, mtime, digest, outputs):
+        """Store (or replace) what a source looked like and what it produced.
+
+        :param source:  source name
+        :param size:    size in bytes
+        :param mtime:   modified time, or None for sources that are only part of a file
+        :param digest:  content hash as hex, or None if it wasn't needed
+        :param outputs: list of full file paths written for this source
+        """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)',
+            (source, size, mtime, digest, json.dumps(outputs)))
+
+    def sources(self):
+        """Return every source from previous runs as (source name, Source) pairs, eg. to merge."""
+        rows = self.connection.execute('SELECT source, size, mtime, digest, outputs FROM sources')
+        return [(row[0], Source(row[1], row[2], row[3], json.loads(row[4]))) for row in rows]
+
+    def setting(self, name):
+        """Look up a setting the Saved folder was made with.
+
+        :param name: setting name, eg. 'output'
+        :returns:    value, or None if it was never set
+        """
+        row = self.connection.execute(
+            'SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_setting(self, name, value):
+        """Store (or replace) a setting the Saved folder was made with.
+
+        :param name:  setting name, eg. 'output'
+        :param value: value as a string
+        """
+        self.connection.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (name, value))
+
+    def contents(self):
+        """Return every saved file from previous runs as (path, size, digest or None) rows."""
+        return self.connection.execute('SELECT path, size, digest FROM contents').fetchall()
+
+    def record_contents(self, rows):
+        """Replace the saved files with the given (path, size, digest or None) rows.
+
+        :param rows: rows from ContentIndex.rows
+        """
+        self.connection.execute('DELETE FROM contents')
+        self.connection.executemany('INSERT INTO contents VALUES (?, ?, ?)', rows)
+
+    def commit(self):
+        """Commit everything recorded so far, eg. between batches of a watch that runs for hours."""
+        self.connection.commit()
+
+    def close(self):
+        """Commit everything recorded and close the database."""
+        self.connection.commit()
+        self.connection.close()
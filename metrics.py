@@ -0,0 +1,170 @@
+"""
+Counters, stage timings and events for an extraction run.
+
+Everything the extractor used to print for each file is an event now. Events are printed as
+before by default; in quiet mode they aren't printed at all, and a single progress line is
+redrawn (at most every PROGRESS_INTERVAL seconds) instead. Events can also be written to a
+JSON-lines log, one object per line with the seconds since the start of the run, the event
+name and its fields.
+
+Stage timings are exclusive - time spent in a stage while it waits on the stage before it
+is counted against that stage, not both - so they add up to the length of the run.
+
+Author - James M. (yakasov)
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+PROGRESS_INTERVAL = 0.5 # Seconds between progress line redraws in quiet mode
+MB = 1024 * 1024
+
+class Metrics:
+    """Everything measured during a run. One per process - workers hand theirs back with take."""
+
+    def __init__(self, verbose=True, progress=False, log=None):
+        """Start measuring.
+
+        :param verbose:  print a line for every event, as the extractor always has
+        :param progress: redraw a progress line on stderr as events come in
+        :param log:      open text file to write events to as JSON lines, a list to collect
+                         them in (eg. in a worker, to be written by the main process), or None
+        """
+        self.verbose = verbose
+        self.progress = progress
+        self.log = log
+        self.counts = Counter() # Event and byte counters, eg. write, skip, bytes_out
+        self.types = Counter()  # Extension -> files saved
+        self.times = Counter()  # Stage -> seconds spent in it
+        self.started = time.perf_counter()
+        self.last_progress = 0
+        self.stack = [] # Stages running, innermost last
+        self.since = self.started # When the innermost stage was last charged for
+
+    def add(self, name, amount=1):
+        """Add to a counter."""
+        self.counts[name] += amount
+
+    def event(self, name, message=None, **fields):
+        """Record something that happened.
+
+        :param name:    event name, also counted in counts
+        :param message: line to print in verbose mode
+        :param fields:  anything else worth logging (must be JSON serialisable)
+        """
+        self.counts[name] += 1
+        if self.verbose and message is not None:
+            print(message)
+        if self.log is not None:
+            record = {'time': round(time.perf_counter() - self.started, 6), 'event': name, **fields}
+            if isinstance(self.log, list) and message is not None:
+                record['message'] = message # For the process this is merged into to print
+            self._log(record)
+        if self.progress:
+            self.show_progress()
+
+    def _log(self, record):
+        if isinstance(self.log, list):
+            self.log.append(record)
+        else:
+            self.log.write(json.dumps(record) + '\n')
+
+    def show_progress(self, force=False):
+        """Redraw the progress line, if it hasn't been redrawn in the last PROGRESS_INTERVAL."""
+        now = time.perf_counter()
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        elapsed = max(now - self.started, 1e-9)
+        saved = self.counts['new_file'] + self.counts['new_data_file'] + self.counts['duplicate']
+        sys.stderr.write(f'\r{saved} files saved -- {self.counts["bytes_out"] / MB:.1f} MB written '
+                         f'-- {saved / elapsed:.0f} files/s -- {elapsed:.0f}s ')
+        sys.stderr.flush()
+
+    def _switch(self, name):
+        """Charge the time since the last switch to the running stage, then start name (if any)."""
+        now = time.perf_counter()
+        if self.stack:
+            self.times[self.stack[-1]] += now - self.since
+        self.since = now
+        if name is None:
+            self.stack.pop()
+        else:
+            self.stack.append(name)
+
+    @contextmanager
+    def timer(self, name):
+        """Time a block of code as the stage name."""
+        self._switch(name)
+        try:
+            yield
+        finally:
+            self._switch(None)
+
+    def timed(self, name, items):
+        """Time a generator as the stage name - only time spent getting each item is counted.
+
+        :param name:  stage name
+        :param items: iterable to time
+        :returns:     generator of the same items
+        """
+        items = iter(items)
+        while True:
+            self._switch(name)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self._switch(None)
+            yield item
+
+    def take(self):
+        """Return everything measured so far (for merge) and start again from zero."""
+        log = self.log if isinstance(self.log, list) else []
+        taken = (self.counts, self.types, self.times, log)
+        self.counts, self.types, self.times = Counter(), Counter(), Counter()
+        if isinstance(self.log, list):
+            self.log = []
+        return taken
+
+    def merge(self, taken):
+        """Add measurements from take (eg. from a worker) to these. Events are printed here in
+        verbose mode, as workers leave that to the process they are merged into."""
+        counts, types, times, events = taken
+        self.counts.update(counts)
+        self.types.update(types)
+        self.times.update(times)
+        for record in events:
+            message = record.pop('message', None)
+            if self.verbose and message is not None:
+                print(message)
+            if self.log is not None:
+                self._log(record)
+        if self.progress:
+            self.show_progress()
+
+    def summary(self):
+        """Return a readable summary of the run."""
+        elapsed = time.perf_counter() - self.started
+        stages = ' -- '.join(f'{name} {seconds:.2f}s' for name, seconds in self.times.most_common())
+        types = ' -- '.join(f'{ext} {count}' for ext, count in self.types.most_common())
+        gz_in, gz_out = self.counts['gz_in'], self.counts['gz_out']
+        ratio = f'{gz_out / gz_in:.1f}x' if gz_in else 'n/a'
+        return (f'Took {elapsed:.2f}s -- {stages or "nothing run"}\n'
+                f'Saved {types or "nothing"}\n'
+                f'Bytes in {self.counts["bytes_in"] / MB:.1f} MB -- '
+                f'Bytes out {self.counts["bytes_out"] / MB:.1f} MB -- '
+                f'GZ {gz_in / MB:.1f} MB -> {gz_out / MB:.1f} MB ({ratio})')
+
+    def close(self):
+        """Finish the progress line and log the summary."""
+        if self.progress:
+            self.show_progress(force=True)
+            sys.stderr.write('\n')
+        if self.log is not None:
+            self._log({'time': round(time.perf_counter() - self.started, 6), 'event': 'summary',
+                       'counts': self.counts, 'types': self.types, 'times': self.times})
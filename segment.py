@@ -0,0 +1,196 @@
+"""
+Plan how a data file is split, from the lengths of its null runs.
+
+Files in a data file are separated by runs of null bytes, but files have null runs of their
+own too - so the shortest run to split at (BYTE_COUNT) is a trade off between cutting files up
+and leaving files stuck together, and the best one depends on the file. Every null run of
+MIN_RUN or more bytes is counted by length in one pass over the file, and the run length to
+split at is picked from where the counts dip between MIN_BYTE_COUNT and MAX_BYTE_COUNT:
+null runs inside files get rarer the longer they are, while the padding between files gets
+more common the longer it is (up to the block size), so the quietest lengths are where the
+one gives way to the other.
+
+If NumPy is installed the pass is vectorised (comparing a block of the file at a time, then
+finding where null runs start and end from the differences between null positions) and takes
+a fraction of a second per GB. Otherwise runs are found with bytes.find, which is slower on
+files with lots of short null runs, but gives the same plan.
+
+Author - James M. (yakasov)
+"""
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError: # Optional, see above
+    numpy = None
+
+MIN_RUN = 8 # Shortest null run counted
+MIN_BYTE_COUNT = 29 # Shortest null run a data file can be split at
+MAX_BYTE_COUNT = 186 # Longest null run a data file has to be split at
+THRESHOLD_STEPS = 4 # Lengths to pick from per doubling, between MIN_BYTE_COUNT and MAX_BYTE_COUNT
+MIN_PLANNED_RUNS = 16 # Fewer runs than this between the two and the default is used instead
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024 # Bytes compared at a time with NumPy
+
+Plan = namedtuple('Plan', ['byte_count', 'picked', 'histogram', 'gaps'])
+Plan.__doc__ = 'How a data file is split - the null run length to split at, and where the runs are.'
+# picked is False if byte_count was given, or there weren't enough runs to pick one
+# histogram is a list of how many runs there are of each length, anything over MAX_BYTE_COUNT
+# counted at MAX_BYTE_COUNT + 1
+# gaps is a list of (start, end) of every run of byte_count or more nulls, in order
+
+def _run_end(data, pos, end):
+    """Return where the null run at pos ends, looking at a growing chunk at a time."""
+    size = 256
+    while pos < end:
+        chunk = data[pos:min(pos + size, end)]
+        nulls = len(chunk) - len(chunk.lstrip(b'\x00'))
+        pos += nulls
+        if nulls < len(chunk):
+            break
+        size = min(size * 2, SCAN_BLOCK_SIZE)
+    return pos
+
+def null_runs(data, min_length, start=0, end=None):
+    """Find every run of min_length or more null bytes, without NumPy.
+
+    :param data:       bytes-like data to search (eg. a memory map)
+    :param min_length: shortest run to find
+    :param start:      offset to search from
+    :param end:        offset to stop searching at (runs are cut off there), None for the end
+    :returns:          generator of (start, end) tuples
+    """
+    end = len(data) if end is None else end
+    needle = b'\x00' * min_length
+    pos = data.find(needle, start, end)
+    while pos != -1:
+        run_end = _run_end(data, pos + min_length, end)
+        yield pos, run_end
+        pos = data.find(needle, run_end, end)
+
+def _scan_numpy(data):
+    """Count null runs by length and find the long ones, a block of data at a time.
+    Any run of MIN_RUN or more nulls covers a whole aligned 4 byte word, so only words are
+    compared - the few runs found are then stretched over the nulls either side of them."""
+    histogram = numpy.zeros(MAX_BYTE_COUNT + 2, numpy.int64)
+    gaps = []
+    values = numpy.frombuffer(data, numpy.uint8)
+    words = values[:len(values) // 4 * 4].view(numpy.uint32)
+    carry = None # First word of a run still going at the end of the last block
+    for offset in range(0, len(words), SCAN_BLOCK_SIZE // 4):
+        zero = numpy.flatnonzero(words[offset:offset + SCAN_BLOCK_SIZE // 4] == 0) + offset
+        breaks = numpy.flatnonzero(numpy.diff(zero) != 1) + 1
+        starts = zero[numpy.append(0, breaks)] if len(zero) else zero
+        ends = zero[numpy.append(breaks - 1, len(zero) - 1)] + 1 if len(zero) else zero
+        if carry is not None:
+            if len(starts) and starts[0] == offset:
+                starts[0] = carry
+            else:
+                starts, ends = numpy.append(carry, starts), numpy.append(offset, ends)
+            carry = None
+        if len(ends) and offset + SCAN_BLOCK_SIZE // 4 == ends[-1] < len(words):
+            carry, starts, ends = int(starts[-1]), starts[:-1], ends[:-1]
+        starts, ends = starts * 4, ends * 4
+        for _ in range(3): # Nulls either side that aren't a whole word
+            before = starts > 0
+            before[before] = values[starts[before] - 1] == 0
+            starts = starts - before
+            after = ends < len(values)
+            after[after] = values[ends[after]] == 0
+            ends = ends + after
+        lengths = ends - starts
+        histogram += numpy.bincount(numpy.minimum(lengths[lengths >= MIN_RUN], MAX_BYTE_COUNT + 1),
+                                    minlength=MAX_BYTE_COUNT + 2)
+        long_runs = lengths >= MIN_BYTE_COUNT
+        gaps.extend(zip(starts[long_runs].tolist(), ends[long_runs].tolist()))
+    del values, words # Done with the data, so it can be closed
+    return histogram.tolist(), gaps
+
+def _scan_python(data):
+    """Count null runs by length and find the long ones, with bytes.find."""
+    histogram = [0] * (MAX_BYTE_COUNT + 2)
+    gaps = []
+    for start, end in null_runs(data, MIN_RUN):
+        histogram[min(end - start, MAX_BYTE_COUNT + 1)] += 1
+        if end - start >= MIN_BYTE_COUNT:
+            gaps.append((start, end))
+    return histogram, gaps
+
+def pick_byte_count(histogram):
+    """Pick the null run length to split at from how many runs there are of each length.
+    Lengths are grouped THRESHOLD_STEPS to a doubling, and the start of the group with the fewest
+    runs is picked (the shortest, if more than one has the fewest).
+
+    :param histogram: run counts by length, from plan
+    :returns:         run length to split at, or None if there are too few runs to tell
+    """
+    if sum(histogram[MIN_BYTE_COUNT:MAX_BYTE_COUNT + 1]) < MIN_PLANNED_RUNS:
+        return None
+    candidates = []
+    length = MIN_BYTE_COUNT
+    while length <= MAX_BYTE_COUNT:
+        candidates.append(length)
+        length = round(MIN_BYTE_COUNT * 2 ** (len(candidates) / THRESHOLD_STEPS))
+    edges = candidates + [MAX_BYTE_COUNT + 1]
+    counts = [sum(histogram[low:high]) for low, high in zip(edges, edges[1:])]
+    return candidates[counts.index(min(counts))]
+
+def plan(data, default, byte_count=None):
+    """Work out where to split a data file.
+
+    :param data:       bytes-like contents of the data file (eg. a memory map)
+    :param default:    run length to split at if there are too few runs to pick one
+    :param byte_count: run length to split at, or None to pick one from the file
+    :returns:          Plan
+    """
+    histogram, gaps = (_scan_numpy if numpy is not None else _scan_python)(data)
+    picked = byte_count is None and pick_byte_count(histogram)
+    byte_count = picked or byte_count or default
+    if byte_count < MIN_BYTE_COUNT: # Shorter than anything kept, so look again
+        gaps = list(null_runs(data, byte_count))
+    return Plan(byte_count, bool(picked), histogram,
+                [(start, end) for start, end in gaps if end - start >= byte_count])
+
+def plan_fragments(split_plan, size, min_size):
+    """Return the pieces a plan splits a data file into, before anything is carved out of them.
+
+    :param split_plan: Plan for the data file
+    :param size:       data file size in bytes
+    :param min_size:   smallest piece kept
+    :returns:          list of (offset, size) tuples
+    """
+    pieces = []
+    pos = 0
+    for start, end in split_plan.gaps + [(size, size)]:
+        if start - pos >= min_size:
+            pieces.append((pos, start - pos))
+        pos = end
+    return pieces
+
+def size_buckets(counts):
+    """Group counts by power of two size, eg. {'32-63': 10}, for reports.
+
+    :param counts: iterable of (size, count) tuples
+    :returns:      dictionary of size range: count, smallest first
+    """
+    buckets = {}
+    for size, count in counts:
+        if count:
+            low = 1 << (size.bit_length() - 1) if size else 0
+            key = f'{low}-{max(low * 2 - 1, 0)}'
+            buckets[key] = buckets.get(key, 0) + count
+    return dict(sorted(buckets.items(), key=lambda item: int(item[0].split('-')[0])))
+
+def report(split_plan, size, pieces):
+    """Return a dry run report of a plan, ready for JSON.
+
+    :param split_plan: Plan for the data file
+    :param size:       data file size in bytes
+    :param pieces:     pieces from plan_fragments
+    :returns:          dictionary of the split and what it makes
+    """
+    return {'size': size, 'byte_count': split_plan.byte_count, 'picked': split_plan.picked,
+            'null_runs': {**size_buckets(enumerate(split_plan.histogram[:MAX_BYTE_COUNT + 1])),
+                          f'{MAX_BYTE_COUNT + 1}+': split_plan.histogram[MAX_BYTE_COUNT + 1]},
+            'fragments': len(pieces),
+            'fragment_sizes': size_buckets((piece_size, 1) for _, piece_size in pieces)}
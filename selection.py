@@ -0,0 +1,54 @@
+"""
+Pick out only part of a cache - by type, size and URL - for targeted pulls.
+
+Each test is made as soon as what it needs is known, so anything left out costs as little as
+possible: URLs and sizes are checked as the cache is listed (before anything is read), the size
+and signature of each data file fragment is checked before it is copied out of the data file,
+and types are checked from the first bytes of each payload - or, for GZ payloads, the first
+expanded chunk, after which nothing more is expanded.
+
+Author - James M. (yakasov)
+"""
+
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+Selection = namedtuple('Selection', ['types', 'min_size', 'max_size', 'url'],
+                       defaults=(None, None, None, None))
+Selection.__doc__ = 'What to extract from a cache - anything left as None is not checked.'
+# types is a set of extensions without the dot, eg. {'PNG', 'JPEG'} (STREAM payloads go with
+# the Office file they are from)
+# min_size and max_size are in bytes, as stored in the cache (so compressed, for GZ)
+# url is a glob the whole key of an index or simple cache entry has to match - nothing else
+# has a key, so with a url only entries can be selected
+
+def parse_types(text):
+    """Read a comma separated list of types, eg. 'PNG,jpeg,.gif'.
+
+    :param text: types as given on the command line
+    :returns:    frozenset of extensions without the dot, in upper case
+    :raises ValueError: if no types are given
+    """
+    types = frozenset(t.strip().lstrip('.').upper() for t in text.split(',') if t.strip(' .'))
+    if not types:
+        raise ValueError(f'No types in {text!r}')
+    return types
+
+def wants_size(selection, size):
+    """Check a payload size against a Selection (or None, which selects everything)."""
+    if selection is None or size is None:
+        return True
+    return ((selection.min_size is None or size >= selection.min_size) and
+            (selection.max_size is None or size <= selection.max_size))
+
+def wants_key(selection, key):
+    """Check an entry key (URL) against a Selection - key is None for payloads without one."""
+    if selection is None or selection.url is None:
+        return True
+    return key is not None and fnmatchcase(key, selection.url)
+
+def wants_type(selection, ext):
+    """Check an extension (eg. '.PNG', or None if unknown) against a Selection."""
+    if selection is None or selection.types is None:
+        return True
+    return ext is not None and ext.lstrip('.') in selection.types
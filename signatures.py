@@ -0,0 +1,122 @@
+"""
+File signatures - the bytes each type of file starts with - and classifying a file by them.
+
+Add a type by adding its signature to HEADERS, and to HEADER_OFFSETS too if it doesn't sit at
+the start of the file. Saved\\unknown_codes.json lists the signatures most worth adding (see
+discovery.py).
+
+Author - James M. (yakasov)
+"""
+
+HEADERS = { # HEADERS must be compressed headers first, then file headers second
+    # COMPRESSED FILETYPE HEADERS BELOW
+    '1F 8B 08': '.GZ',
+    '37 7A BC AF 27 1C': '.7Z',
+    '50 4B 03 04': '.ZIP',
+    # We don't actually process 7z or zip files
+    # But we put them here so they don't get counted as unknown (see unknown_codes.json)
+    #
+    # DOCUMENT-ESQUE FILETYPE HEADERS BELOW
+    '50 4B 03 04 14 00 06 00': '.OOXML', # DOCX, PPTX, XLSX
+    'D0 CF 11 E0 A1 B1 1A E1': '.OFFICE', # Compound file, cfb.py finds the kind from its directory
+    'FD FF FF FF': '.OFFICE', # These files need manual checking, rules below HEADERS dic
+    '   6E 1E F0': '.PPT', #                         Prepend 0 byte   + 0x200 byte offset
+    ' F 00 E8 03': '.PPT', #                         Prepend 0 nibble + 0x200 byte offset
+    'A0 46 1D F0': '.PPT', #                                          + 0x200 byte offset
+    'EC A5 C1 00': '.DOC', #                                          + 0x200 byte offset
+    ' 9 08 10 00 00 06 05 00': '.XLS', #             Prepend 0 nibble + 0x200 byte offset
+    '25 50 44 46': '.PDF',
+    '52 00 6F 00 6F 00 74 00': '.MSG', # Outlook/Exchange message     + 0x200 byte offset
+    #
+    # MEDIA FILETYPE HEADERS BELOW
+    '89 50 4E 47 0D 0A 1A 0A': '.PNG',
+    'FF D8 FF': '.JPEG',
+    '49 44 33': '.MP3',
+    '7B 5C 72 74 66': '.RTF',
+    '47 49 46 38': '.GIF',   # Followed by 37 61 or 39 61
+    '77 4F 46 32': '.WOFF2', # Web Open Font Format 2
+    'EF BB BF 3C': '.HTML',  # Same signature for WSC
+    '3C 21': '.HTML',        # Starts with <! (for DOCTYPE)
+    #
+    # OTHER FILETYPE HEADERS BELOW
+    '6E 70 6D': '.LOG',      # npm log files
+    '22 75 73 65': '.JS',    # Fallback: these files all start with "use
+    '2F 2A': '.JS',          # Fallback: these files all start with /*
+    '7B 22': '.JSON',        # Fallback: these files all start with {
+}
+
+# Rules for .OFFICE file types:
+# These are all compound files - the streams in their directory say which kind they are
+# (see cfb.py), so the offset rules are only used when the directory can't be read.
+#
+# All the .OFFICE files are usually prepended by a 0x200 (512) byte offset
+#      00 01 02 03 04 05 06 07 08 09 10 11 12 13 14 15
+# PPT: FD FF FF FF nn nn 00 00
+# XLS: FD FF FF FF nn 00
+# or   FD FF FF FF nn 02
+# or   FD FF FF FF 20 00 00 00
+# DB : FD FF FF FF xx xx xx xx xx xx xx xx 04 00 00 00
+
+HEADER_OFFSETS = { # Signatures from HEADERS that sit after the 0x200 byte offset
+    'FD FF FF FF': 0x200,
+    '   6E 1E F0': 0x200,
+    ' F 00 E8 03': 0x200,
+    'A0 46 1D F0': 0x200,
+    'EC A5 C1 00': 0x200,
+    ' 9 08 10 00 00 06 05 00': 0x200,
+    '52 00 6F 00 6F 00 74 00': 0x200,
+}
+
+def signature_bytes(hex_code):
+    """Turn a HEADERS key into the raw bytes it describes.
+    Keys are laid out as 'XX XX XX', so any blank leading columns are 0 nibbles.
+
+    :param hex_code: signature key from HEADERS
+    :returns:        signature as bytes
+    """
+    byte_length = (len(hex_code) + 1) // 3
+    return bytes.fromhex(hex_code.replace(' ', '').rjust(byte_length * 2, '0'))
+
+def compile_headers(headers, offsets):
+    """Compile HEADERS into a byte trie per offset, so a file can be classified
+    by walking its header once instead of comparing against every signature.
+
+    :param headers: signature to extension dictionary (HEADERS)
+    :param offsets: signature to byte offset dictionary (HEADER_OFFSETS)
+    :returns:       tuple of ({offset: trie}, header window length)
+    """
+    tries = {}
+    window = 0
+    for hex_code, ext in headers.items():
+        sig = signature_bytes(hex_code)
+        offset = offsets.get(hex_code, 0)
+        node = tries.setdefault(offset, {})
+        for byte in sig:
+            node = node.setdefault(byte, {})
+        node.setdefault(None, ext) # Earlier HEADERS entries win if a signature repeats
+        window = max(window, offset + len(sig))
+    return tries, window
+
+SIGNATURE_TRIES, HEADER_WINDOW = compile_headers(HEADERS, HEADER_OFFSETS)
+
+def classify(content):
+    """Find the most specific HEADERS match for the start of a file.
+    Only the first HEADER_WINDOW bytes are ever looked at.
+
+    :param content: file contents (or at least the first HEADER_WINDOW bytes) as bytes
+    :returns:       matching extension, or None if no signature matches
+    """
+    if not content:
+        return None
+    window = content[:HEADER_WINDOW]
+    best_ext, best_length = None, 0
+    for offset, node in SIGNATURE_TRIES.items():
+        length = 0
+        for byte in window[offset:]:
+            node = node.get(byte)
+            if node is None:
+                break
+            length += 1
+            if None in node and length > best_length: # Longer signature = more specific
+                best_ext, best_length = node[None], length
+    return best_ext
@@ -0,0 +1,79 @@
+"""
+Read entries from a Chromium disk cache in the simple format - the layout newer (WebView2 based)
+Teams clients can leave behind instead of data_N block files.
+
+Each entry is a <hash>_0 file of its own: a header and the key (the URL), then the body (stream 1)
+and an EOF record, then the HTTP response headers (stream 0), an optional SHA-256 of the key and
+a last EOF record. Stream sizes are only in the EOF records, so an entry is read from both ends -
+the header and key at the start, the two EOF records at the end - and the body is never read
+here, only located. Entries that haven't been finished (or are cut off) have no final EOF record
+and are skipped. Stream 2 (<hash>_1) and sparse data (<hash>_s) aren't read.
+
+Layouts follow net/disk_cache/simple/simple_entry_format.h in the Chromium source.
+
+Author - James M. (yakasov)
+"""
+
+from os.path import getsize
+import re
+import struct
+
+from blockfile import BODY_STREAM, HEADERS_STREAM, STREAM_COUNT, CacheEntry, Stream
+
+INITIAL_MAGIC = 0xFCFB6D1BA7725C30
+FINAL_MAGIC = 0xF4FA6F45970D41D8
+FILE_HEADER = struct.Struct('<QIII4x') # initial magic, version, key length, key hash
+FILE_EOF = struct.Struct('<QIII4x') # final magic, flags, data CRC32, stream size
+MIN_VERSION, MAX_VERSION = 5, 9 # Versions that share this layout
+FLAG_HAS_KEY_SHA256 = 2
+KEY_SHA256_SIZE = 32
+MAX_KEY_LENGTH = 64 * 1024 # Longer than any real key, stops a broken header being read as one
+ENTRY_FILE = re.compile(r'[0-9a-f]{16}_0') # Streams 0 and 1 of an entry, named by the key's hash
+
+def is_entry_file(name):
+    """Check if a cache file name is the streams 0 and 1 file of a simple cache entry."""
+    return ENTRY_FILE.fullmatch(name) is not None
+
+def read_entry(path):
+    """Locate the key and streams of a simple cache entry from its header and EOF records.
+
+    :param path: full file path of the <hash>_0 file
+    :returns:    CacheEntry (with the body and headers Streams, either may be None if empty)
+    :raises ValueError: if it isn't a whole simple cache entry
+    """
+    try:
+        size = getsize(path)
+        with open(path, 'rb') as f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) < FILE_HEADER.size:
+                raise ValueError(f'{path} is too short to be a simple cache entry')
+            magic, version, key_length, key_hash = FILE_HEADER.unpack(header)
+            if magic != INITIAL_MAGIC or not MIN_VERSION <= version <= MAX_VERSION:
+                raise ValueError(f'{path} is not a simple cache entry')
+            if key_length > min(MAX_KEY_LENGTH, size - FILE_HEADER.size - 2 * FILE_EOF.size):
+                raise ValueError(f'{path} has a broken key length')
+            key = f.read(key_length)
+
+            f.seek(size - FILE_EOF.size)
+            magic, flags, _, headers_size = FILE_EOF.unpack(f.read(FILE_EOF.size))
+            if magic != FINAL_MAGIC:
+                raise ValueError(f'{path} is not a finished simple cache entry')
+            headers_end = (size - FILE_EOF.size
+                           - (KEY_SHA256_SIZE if flags & FLAG_HAS_KEY_SHA256 else 0))
+            body_eof = headers_end - headers_size - FILE_EOF.size
+            body_start = FILE_HEADER.size + key_length
+            if body_eof < body_start:
+                raise ValueError(f'{path} has a broken stream 0 size')
+            f.seek(body_eof)
+            magic, _, _, body_size = FILE_EOF.unpack(f.read(FILE_EOF.size))
+    except (OSError, struct.error) as e:
+        raise ValueError(f'Could not read {path}') from e
+    if magic != FINAL_MAGIC or body_start + body_size != body_eof:
+        raise ValueError(f'{path} has a broken stream 1 EOF record')
+
+    streams = [None] * STREAM_COUNT
+    if headers_size > 0:
+        streams[HEADERS_STREAM] = Stream(path, body_eof + FILE_EOF.size, headers_size)
+    if body_size > 0:
+        streams[BODY_STREAM] = Stream(path, body_start, body_size)
+    return CacheEntry(key_hash, key.decode('utf-8', 'replace'), tuple(streams))
@@ -0,0 +1,504 @@
+"""
+Places to save extracted files to.
+
+Every sink takes outputs as a folder (the extension, eg. PNG, or DATA) and a file name, and
+gives back a location string that is used to refer to the output from then on (in the manifest
+and the content index). The sinks are:
+
+    dir    - Saved\\<EXT>\\<name> files, the original layout
+    tar    - one Saved\\Saved.tar archive, appended to on later runs
+    zip    - one Saved\\Saved.zip archive, appended to on later runs
+    sqlite - one Saved\\Saved.sqlite database, each content stored once as a blob
+
+Writing one archive instead of thousands of small files is much faster on network shares.
+The dir sink can instead write behind - outputs are handed to a few threads to write while the
+next ones are extracted, so on a slow share the waiting overlaps with the extracting.
+Outputs can't be removed from archives - a changed entry is added again under the same name,
+and the last member of a name is the one that counts (as when an archive is extracted).
+
+Author - James M. (yakasov)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from os.path import dirname, isdir, isfile, join
+import os
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import time
+import warnings
+import zipfile
+
+from dedupe import file_digest, link_file, new_digest
+
+LINK_OUTPUTS = False # Hardlink outputs to the cache files instead of copying them (dir sink)
+# Only turn this on if the cache is already a copy - the outputs will share the same data
+COPY_CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024 # Tar members and sqlite blobs over this are spooled to a temp file
+SQLITE_BATCH_SIZE = 500 # Outputs written per transaction in the sqlite sink
+WRITE_BEHIND_MEMORY = 64 * 1024 * 1024 # Most output data waiting to be written by the dir sink
+KERNEL_COPIES = [] # Ways to copy between files without the bytes passing through Python
+if hasattr(os, 'copy_file_range'):
+    KERNEL_COPIES.append(
+        lambda src, dst, offset, count: os.copy_file_range(src, dst, count, offset))
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'): # Other platforms need a socket
+    KERNEL_COPIES.append(lambda src, dst, offset, count: os.sendfile(dst, src, offset, count))
+
+def copy_payload(src, dst, offset=0, size=None):
+    """Copy a file (or a byte range of it) without reading it into Python.
+    Tries a hardlink (if LINK_OUTPUTS and copying the whole file), then the kernel-side
+    copies in KERNEL_COPIES, then falls back to a chunked read/write.
+
+    :param src:    full file path to copy from
+    :param dst:    full file path to copy to (file yet to be created)
+    :param offset: byte offset in src to start copying from
+    :param size:   number of bytes to copy, None for everything after offset
+    """
+    if LINK_OUTPUTS and offset == 0 and (size is None or size == os.stat(src).st_size):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass # Different drive, or links aren't supported here
+    with open(src, 'rb') as fsrc, open(dst, 'wb', buffering=0) as fdst:
+        if size is None:
+            size = os.fstat(fsrc.fileno()).st_size - offset
+        copied = 0
+        for kernel_copy in KERNEL_COPIES:
+            try:
+                while copied < size:
+                    sent = kernel_copy(fsrc.fileno(), fdst.fileno(), offset + copied, size - copied)
+                    if sent == 0:
+                        return # Source is shorter than expected, nothing more to copy
+                    copied += sent
+                return
+            except OSError:
+                pass # Not supported between these filesystems, try the next one
+        fsrc.seek(offset + copied)
+        while copied < size:
+            chunk = fsrc.read(min(COPY_CHUNK_SIZE, size - copied))
+            if not chunk:
+                break
+            fdst.write(chunk)
+            copied += len(chunk)
+
+def read_range(src, offset, size):
+    """Yield a byte range of a file a chunk at a time.
+
+    :param src:    full file path
+    :param offset: byte offset to start from
+    :param size:   number of bytes to read
+    :returns:      generator of bytes chunks
+    """
+    with open(src, 'rb') as f:
+        f.seek(offset)
+        while size > 0:
+            chunk = f.read(min(COPY_CHUNK_SIZE, size))
+            if not chunk:
+                return
+            size -= len(chunk)
+            yield chunk
+
+class HashingReader:
+    """File-like wrapper that hashes everything read through it, for archive writers."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.digest = new_digest()
+        self.size = 0
+
+    def read(self, size=-1):
+        """Read up to size bytes (everything left if size is negative)."""
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.digest.update(data)
+        self.size += len(data)
+        return data
+
+class DirectorySink:
+    """Saved\\<EXT>\\<name> files. Folders are made the first time something is saved in them.
+    With write_behind, up to that many outputs (and at most memory bytes of them) are written
+    by background threads. An output still waiting to be written is finished before anything
+    else touches it, so the sink behaves the same either way."""
+
+    def __init__(self, root, write_behind=0, memory=WRITE_BEHIND_MEMORY):
+        """Open the sink.
+
+        :param root:         full directory path of the Saved folder
+        :param write_behind: outputs to write in the background at once, 0 to write straight away
+        :param memory:       most bytes of output data held waiting to be written
+        """
+        self.root = root
+        self.folders = set()
+        self.depth = write_behind
+        self.memory = memory
+        self.pool = ThreadPoolExecutor(write_behind) if write_behind > 0 else None
+        self.pending = {} # location -> (future, bytes held), oldest first
+        self.held = 0
+        self.failed = []  # (location, error) of background writes that failed
+
+    def location(self, folder, name):
+        """Return the full file path of an output."""
+        return join(self.root, folder, name)
+
+    def _make_folder(self, location):
+        folder = dirname(location)
+        if folder not in self.folders:
+            if not isdir(folder):
+                os.mkdir(folder)
+            self.folders.add(folder)
+
+    def _submit(self, location, held, function, *args):
+        """Run function in the background for location, once there is room for it."""
+        self._finish(location)
+        while self.pending and (len(self.pending) >= self.depth or self.held + held > self.memory):
+            self._finish(next(iter(self.pending)))
+        self.pending[location] = (self.pool.submit(function, *args), held)
+        self.held += held
+
+    def _finish(self, location, cancel=False):
+        """Wait for a background write to location, if there is one.
+
+        :param cancel: drop the write instead if it hasn't started yet
+        """
+        if location not in self.pending:
+            return
+        future, held = self.pending.pop(location)
+        self.held -= held
+        if cancel and future.cancel():
+            return
+        try:
+            future.result()
+        except OSError as e:
+            self.failed.append((location, e))
+
+    def exists(self, location):
+        """Check if an output has already been saved."""
+        return location in self.pending or isfile(location)
+
+    def write(self, location, chunks):
+        """Save an iterable of bytes chunks. Returns (size, digest).
+        When writing behind, the chunks are read (and hashed) now and written later, unless
+        there are more than memory bytes of them."""
+        self._make_folder(location)
+        digest, size = new_digest(), 0
+        if self.pool is not None:
+            chunks, data = iter(chunks), []
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                data.append(bytes(chunk))
+                if size > self.memory:
+                    chunks = chain(data, chunks) # Too big to hold, write it out now instead
+                    digest, size = new_digest(), 0
+                    break
+            else:
+                self._submit(location, size, _write_chunks, location, data)
+                return size, digest.hexdigest()
+            self._finish(location)
+        with open(location, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        return size, digest.hexdigest()
+
+    def copy(self, location, src, offset, size):
+        """Save a byte range of a cache file, kernel-side where possible. Returns the digest, or
+        None as copies aren't hashed."""
+        self._make_folder(location)
+        if self.pool is not None:
+            self._submit(location, 0, copy_payload, src, location, offset, size)
+        else:
+            copy_payload(src, location, offset, size)
+
+    def link(self, existing, location):
+        """Save an output as a hardlink to an earlier one. Returns False if that isn't possible."""
+        self._make_folder(location)
+        self._finish(existing)
+        self._finish(location, cancel=True) # No point writing what is about to be replaced
+        return link_file(existing, location)
+
+    def digest(self, location):
+        """Return the content hash of a saved output, or None if it is gone."""
+        self._finish(location)
+        return file_digest(location) if isfile(location) else None
+
+    def remove(self, location):
+        """Remove a saved output."""
+        self._finish(location, cancel=True)
+        if isfile(location):
+            os.remove(location)
+
+    def flush(self):
+        """Wait for every background write. Returns (location, error) for any that failed."""
+        while self.pending:
+            self._finish(next(iter(self.pending)))
+        failed, self.failed = self.failed, []
+        return failed
+
+    def close(self):
+        """Finish writing. Returns (location, error) for any background writes that failed."""
+        failed = self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+        return failed
+
+def _write_chunks(location, chunks):
+    """Write a list of bytes chunks to a new file."""
+    with open(location, 'wb') as f:
+        f.writelines(chunks)
+
+class TarSink:
+    """One tar archive. Duplicates are stored as tar hardlink members."""
+
+    def __init__(self, path):
+        # Creates the archive if it isn't there yet, and stays open until close
+        self.tar = tarfile.open(path, 'a') # pylint: disable=consider-using-with
+        self.names = set(self.tar.getnames())
+        self.digests = {}
+
+    def location(self, folder, name):
+        """Return the archive member name of an output."""
+        return f'{folder}/{name}'
+
+    def exists(self, location):
+        """Check if an output has already been saved."""
+        return location in self.names
+
+    def _add(self, location, reader, size):
+        info = tarfile.TarInfo(location)
+        info.size, info.mtime = size, time.time()
+        self.tar.addfile(info, reader)
+        self.names.add(location)
+        self.digests[location] = reader.digest.hexdigest()
+        return self.digests[location]
+
+    def write(self, location, chunks):
+        """Save an iterable of bytes chunks. The size has to be known up front, so the chunks
+        are spooled (in memory up to SPOOL_SIZE) first. Returns (size, digest)."""
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            for chunk in chunks:
+                spool.write(chunk)
+            size = spool.tell()
+            spool.seek(0)
+            reader = HashingReader(iter(lambda: spool.read(COPY_CHUNK_SIZE), b''))
+            return size, self._add(location, reader, size)
+
+    def copy(self, location, src, offset, size):
+        """Save a byte range of a cache file. Returns the digest."""
+        return self._add(location, HashingReader(read_range(src, offset, size)), size)
+
+    def link(self, existing, location):
+        """Save an output as a hardlink member pointing at an earlier one."""
+        info = tarfile.TarInfo(location)
+        info.type, info.linkname, info.mtime = tarfile.LNKTYPE, existing, time.time()
+        self.tar.addfile(info)
+        self.names.add(location)
+        self.digests[location] = self.digests.get(existing)
+        return True
+
+    def digest(self, location):
+        """Return the content hash of an output saved this run, else None."""
+        return self.digests.get(location)
+
+    def remove(self, location):
+        """Forget a member, so it is added again (members can't be removed from an archive)."""
+        self.names.discard(location)
+        self.digests.pop(location, None)
+
+    def flush(self):
+        """The archive is only finished on close."""
+        return []
+
+    def close(self):
+        """Finish the archive."""
+        self.tar.close()
+        return []
+
+class ZipSink:
+    """One zip archive. Zip has no links, so duplicates are stored again."""
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'a') # pylint: disable=consider-using-with
+        self.names = set(self.zip.namelist())
+        self.digests = {}
+
+    def location(self, folder, name):
+        """Return the archive member name of an output."""
+        return f'{folder}/{name}'
+
+    def exists(self, location):
+        """Check if an output has already been saved."""
+        return location in self.names
+
+    def write(self, location, chunks):
+        """Save an iterable of bytes chunks. Returns (size, digest)."""
+        digest, size = new_digest(), 0
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', 'Duplicate name', UserWarning) # Removed, see remove
+            f = self.zip.open(location, 'w', force_zip64=True)
+        with f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        self.names.add(location)
+        self.digests[location] = digest.hexdigest()
+        return size, self.digests[location]
+
+    def copy(self, location, src, offset, size):
+        """Save a byte range of a cache file. Returns the digest."""
+        return self.write(location, read_range(src, offset, size))[1]
+
+    def link(self, _existing, _location):
+        """Zip archives can't link members."""
+        return False
+
+    def digest(self, location):
+        """Return the content hash of a saved output."""
+        if location not in self.digests and location in self.names:
+            with self.zip.open(location) as f:
+                digest = new_digest()
+                for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            self.digests[location] = digest.hexdigest()
+        return self.digests.get(location)
+
+    def remove(self, location):
+        """Forget a member, so it is added again (members can't be removed from an archive)."""
+        self.names.discard(location)
+        self.digests.pop(location, None)
+
+    def flush(self):
+        """The archive is only finished on close."""
+        return []
+
+    def close(self):
+        """Finish the archive."""
+        self.zip.close()
+        return []
+
+class SqliteSink:
+    """One SQLite database. Each content is stored once as a blob, and every output is a row
+    pointing at its blob. Writes are committed in batches of SQLITE_BATCH_SIZE."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60) # Workers share the database
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, data BLOB)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'location TEXT PRIMARY KEY, digest TEXT, size INTEGER)')
+        self.pending = 0
+
+    def location(self, folder, name):
+        """Return the row name of an output."""
+        return f'{folder}/{name}'
+
+    def exists(self, location):
+        """Check if an output has already been saved."""
+        return self.digest(location) is not None
+
+    def write(self, location, chunks):
+        """Save an iterable of bytes chunks. Blobs are stored by their digest, so the chunks are
+        hashed as they are spooled (in memory up to SPOOL_SIZE) first. Returns (size, digest)."""
+        digest = new_digest()
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            for chunk in chunks:
+                spool.write(chunk)
+                digest.update(chunk)
+            size, digest = spool.tell(), digest.hexdigest()
+            spool.seek(0)
+            self._store(digest, size, iter(lambda: spool.read(COPY_CHUNK_SIZE), b''))
+        self._add(location, digest, size)
+        return size, digest
+
+    def _store(self, digest, size, chunks):
+        """Store a blob, unless one with the same digest already is. It is streamed into the
+        database a chunk at a time where sqlite3 can (Python 3.11+), else written all at once."""
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO blobs VALUES (?, zeroblob(?))', (digest, size))
+        if cursor.rowcount == 0:
+            return
+        if not hasattr(self.connection, 'blobopen'):
+            self.connection.execute('UPDATE blobs SET data = ? WHERE rowid = ?',
+                                    (b''.join(chunks), cursor.lastrowid))
+            return
+        with self.connection.blobopen('blobs', 'data', cursor.lastrowid) as blob:
+            for chunk in chunks:
+                blob.write(chunk)
+
+    def copy(self, location, src, offset, size):
+        """Save a byte range of a cache file. Returns the digest."""
+        return self.write(location, read_range(src, offset, size))[1]
+
+    def link(self, existing, location):
+        """Save an output as another row pointing at an earlier output's blob."""
+        row = self.connection.execute(
+            'SELECT digest, size FROM files WHERE location = ?', (existing,)).fetchone()
+        if row is None:
+            return False
+        self._add(location, *row)
+        return True
+
+    def _add(self, location, digest, size):
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                                (location, digest, size))
+        self.pending += 1
+        if self.pending >= SQLITE_BATCH_SIZE:
+            self.flush()
+
+    def digest(self, location):
+        """Return the content hash of a saved output, or None if there isn't one."""
+        row = self.connection.execute(
+            'SELECT digest FROM files WHERE location = ?', (location,)).fetchone()
+        return None if row is None else row[0]
+
+    def remove(self, location):
+        """Remove a saved output. Its blob is kept, as other outputs may share it."""
+        self.connection.execute('DELETE FROM files WHERE location = ?', (location,))
+
+    def flush(self):
+        """Commit everything written so far."""
+        self.connection.commit()
+        self.pending = 0
+        return []
+
+    def close(self):
+        """Commit and close the database."""
+        self.flush()
+        self.connection.close()
+        return []
+
+SINKS = { # --output name: (sink, file name in the Saved folder or None for the folder itself)
+    'dir': (DirectorySink, None),
+    'tar': (TarSink, 'Saved.tar'),
+    'zip': (ZipSink, 'Saved.zip'),
+    'sqlite': (SqliteSink, 'Saved.sqlite'),
+}
+
+def open_sink(kind, save_path, write_behind=0, memory=WRITE_BEHIND_MEMORY):
+    """Open one of the SINKS inside the Saved folder.
+
+    :param kind:         key from SINKS
+    :param save_path:    full directory path (...path\\Saved)
+    :param write_behind: outputs to write in the background at once (dir sink only)
+    :param memory:       most bytes of output data held waiting to be written (dir sink only)
+    :returns:            sink instance
+    """
+    sink, file_name = SINKS[kind]
+    if file_name is None: # Archives and databases are one file, only folders can write behind
+        return sink(save_path, write_behind, memory)
+    return sink(join(save_path, file_name))
@@ -0,0 +1,143 @@
+"""
+Extract a cache folder as it changes (file_to_extension.py --watch) - everything already in it
+first, then every cache file that is created or written to, a batch at a time. Linux only, as
+changes are picked up with inotify (see inotify.py).
+
+Author - James M. (yakasov)
+"""
+
+from os import mkdir
+from os.path import isdir, isfile, join
+import mmap
+import os
+import time
+
+import file_to_extension as fte
+from inotify import Inotify
+from metrics import Metrics
+from segment import null_runs
+from selection import wants_key
+
+WATCH_DEBOUNCE = 0.5 # Seconds changes are gathered for before they are extracted
+
+def settled_end(full_path, start=0, byte_count=fte.BYTE_COUNT):
+    """Return where the last run of byte_count or more null bytes after start ends in a data file.
+    Everything before it can be split without cutting a piece that is still being written,
+    as long as the file only grows.
+
+    :param full_path:  full file path of the data file
+    :param start:      offset to look from
+    :param byte_count: shortest null run to split at
+    :returns:          offset of the end of the last null run, or start if there isn't one
+    """
+    with open(full_path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return start
+    with mm:
+        end = start
+        for _, end in null_runs(mm, byte_count, start):
+            pass
+        return end
+
+def changed_payloads(folder, names, splits):
+    """Yield a Payload for each cache file that changed while watching. Loose files are passed on
+    as in a full run (see file_to_extension.loose_payload), and data files are split from where
+    they were split up to last time - only as far as their last null run, as anything after it
+    could still be being written.
+
+    :param folder: full directory path of the cache
+    :param names:  names of the files that changed
+    :param splits: data file name -> (offset split up to, fragments so far), updated as they
+                   are split
+    :returns:      generator of Payload
+    """
+    for name in names:
+        path = join(folder, name)
+        if not isfile(path):
+            continue # Deleted, or a folder
+        if name not in fte.DATA_FILES:
+            if (payload := fte.loose_payload(folder, name)) is not None:
+                yield payload
+            continue
+        if not wants_key(fte.SELECT, None):
+            continue
+        size = os.stat(path).st_size
+        start, count = splits.get(name, (0, 0))
+        if size < start: # Replaced with a new data file, so start again
+            start, count = 0, 0
+        # Split at the same count every time, as a picked one could change as the file grows
+        byte_count = fte.SPLIT_BYTE_COUNT or fte.BYTE_COUNT
+        end = settled_end(path, start, byte_count)
+        fte.METRICS.add('bytes_in', end - start)
+        resume = start
+        for offset, fragment in fte.find_fragments(path, start, end, byte_count):
+            count += 1
+            resume = max(resume, offset + len(fragment))
+            if not fte.fragment_selected(fragment):
+                continue
+            # Numbered on from the last split, so fragments are named the same as in a full run
+            yield fte.Payload(f'{name}_{count}', path, offset, len(fragment), None,
+                              'fragment', head=bytes(fragment[:fte.SNIFF_SIZE]))
+        splits[name] = (resume, count)
+
+def watch(source, options=None, debounce=WATCH_DEBOUNCE):
+    """Extract a cache folder as it changes - everything already in it first, then every cache
+    file that is created or written to, within debounce seconds of it changing. Data files are
+    always split (the index isn't read), but only from where they were split up to before - see
+    changed_payloads. Runs until the caller stops taking results, with the manifest committed
+    after every batch. Everything runs in this process - options.workers is ignored.
+
+    :param source:   full directory path of the cache
+    :param options:  file_to_extension.Options, or None for the defaults
+    :param debounce: seconds to gather changes for after the first one, before extracting them
+    :returns:        generator of file_to_extension.Result
+    """
+    options = options or fte.Options()
+    save_path = options.save_path or join(source, 'Saved')
+    fte.check_save_path(save_path)
+
+    fte.apply_options(options)
+    fte.METRICS = Metrics(options.verbose, options.progress, options.log)
+    fte.take_counts()
+    fte.MANIFEST_UPDATES.clear()
+    if not isdir(save_path):
+        mkdir(save_path)
+    manifest = fte.open_manifest(save_path, options.output)
+    fte.open_output(options.output, save_path, manifest.contents())
+    splits = {}
+    try:
+        with Inotify(source) as inotify: # Watching before the first batch, so nothing is missed
+            now = time.perf_counter()
+            changed = dict.fromkeys(fte.get_file_list(source), now) # Name -> when it first changed
+            while True:
+                names = inotify.read(max(min(changed.values()) + debounce - time.perf_counter(), 0)
+                                     if changed else None)
+                if None in names: # Events were lost, so look at everything
+                    names = fte.get_file_list(source)
+                now = time.perf_counter()
+                for name in names:
+                    changed.setdefault(name, now)
+                if not changed or min(changed.values()) + debounce > now:
+                    continue
+                batch, changed = changed, {}
+                payloads = fte.METRICS.timed('source', changed_payloads(source, batch, splits))
+                payloads = fte.manifest_stage(payloads, manifest, ('file', 'entry', 'fragment'))
+                payloads = fte.METRICS.timed('manifest', payloads)
+                yield from fte.extract_stages(payloads)
+                fte.report_failed(fte.SINK.flush())
+                fte.update_manifest(manifest)
+                manifest.commit()
+                done = time.perf_counter()
+                for name, seen in batch.items():
+                    fte.METRICS.add('latency', done - seen)
+                    fte.METRICS.event('changed', f'{name} extracted '
+                                      f'{(done - seen) * 1000:.0f}ms after it changed',
+                                      file=name, latency=round(done - seen, 6))
+    finally:
+        manifest.record_contents(fte.CONTENTS.rows())
+        fte.SINK.close()
+        manifest.close()
+        fte.output_unknown_headers(save_path)
+        fte.METRICS.close()